@@ -0,0 +1,267 @@
+"""Offline benchmark of the proto to parquet conversion.
+
+Synthetic export files are written to a local directory standing in for S3,
+then listed and converted by the same activities the workflow runs. Reports
+events/sec, peak RSS and bytes written, and can fail when throughput drops
+below a threshold so it can gate regressions on the conversion path:
+
+    poetry run python -m cloud_export_to_parquet.benchmark --files 4 --histories 500
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional
+
+import temporalio.api.export.v1 as export
+from temporalio.api.enums.v1 import EventType
+from temporalio.api.history.v1 import History
+from temporalio.testing import ActivityEnvironment
+
+if sys.platform != "win32":
+    import resource
+
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransActivities,
+    DataTransAndLandActivityInput,
+    GetObjectKeysActivityInput,
+)
+from cloud_export_to_parquet.local_s3 import LocalS3
+
+
+class _LocalDataTransActivities(DataTransActivities):
+    def __init__(self, s3: LocalS3) -> None:
+        super().__init__()
+        self._local_s3 = s3
+
+    @property
+    def s3(self) -> Any:
+        return self._local_s3
+
+
+def _random_bytes(rng: random.Random, size: int) -> bytes:
+    # Random.randbytes needs Python 3.9
+    return rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+
+def make_workflow_executions(
+    histories: int, activities: int, payload_bytes: int, seed: int
+) -> export.WorkflowExecutions:
+    """Function that generates synthetic exported histories.
+
+    Each history starts a workflow, runs ``activities`` activities one after
+    the other and completes, with payloads of ``payload_bytes`` random bytes.
+    """
+    rng = random.Random(seed)
+    wfs = export.WorkflowExecutions()
+    for h in range(histories):
+        history = History()
+        event_id = 0
+
+        def add_event(event_type: int) -> Any:
+            nonlocal event_id
+            event_id += 1
+            event = history.events.add(event_id=event_id, event_type=event_type)
+            event.event_time.FromSeconds(1700000000 + event_id)
+            event.task_id = rng.randrange(1 << 40)
+            return event
+
+        started = add_event(
+            EventType.EVENT_TYPE_WORKFLOW_EXECUTION_STARTED
+        ).workflow_execution_started_event_attributes
+        started.workflow_id = f"workflow-{seed}-{h}"
+        started.original_execution_run_id = f"run-{seed}-{h}"
+        started.workflow_type.name = "BenchmarkWorkflow"
+        started.task_queue.name = "benchmark"
+        started.workflow_run_timeout.FromSeconds(3600)
+        started.input.payloads.add(data=_random_bytes(rng, payload_bytes))
+        started.attempt = 1
+        for a in range(activities):
+            add_event(EventType.EVENT_TYPE_WORKFLOW_TASK_SCHEDULED)
+            add_event(EventType.EVENT_TYPE_WORKFLOW_TASK_STARTED)
+            completed = add_event(
+                EventType.EVENT_TYPE_WORKFLOW_TASK_COMPLETED
+            ).workflow_task_completed_event_attributes
+            completed.scheduled_event_id = event_id - 2
+            completed.identity = "benchmark-worker"
+            scheduled = add_event(
+                EventType.EVENT_TYPE_ACTIVITY_TASK_SCHEDULED
+            ).activity_task_scheduled_event_attributes
+            scheduled.activity_id = str(a)
+            scheduled.activity_type.name = "benchmark_activity"
+            scheduled.input.payloads.add(data=_random_bytes(rng, payload_bytes))
+            scheduled.start_to_close_timeout.FromSeconds(60)
+            scheduled.retry_policy.backoff_coefficient = 2.0
+            scheduled_event_id = event_id
+            add_event(EventType.EVENT_TYPE_ACTIVITY_TASK_STARTED)
+            activity_completed = add_event(
+                EventType.EVENT_TYPE_ACTIVITY_TASK_COMPLETED
+            ).activity_task_completed_event_attributes
+            activity_completed.scheduled_event_id = scheduled_event_id
+            activity_completed.result.payloads.add(
+                data=_random_bytes(rng, payload_bytes)
+            )
+        add_event(EventType.EVENT_TYPE_WORKFLOW_EXECUTION_COMPLETED)
+        wfs.items.add(history=history)
+    return wfs
+
+
+@dataclass
+class BenchmarkResult:
+    files: int
+    events: int
+    input_bytes: int
+    output_bytes: int
+    output_files: int
+    seconds: float
+    events_per_sec: float
+    # Peak resident memory of the converting process, if the platform reports
+    # it
+    peak_rss_bytes: Optional[int]
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    # resource is Unix only
+    if sys.platform != "win32":
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    return None
+
+
+def _convert(root: str, prefix: str, row_group_size: int) -> Dict[str, Any]:
+    # Runs in a spawned process so peak RSS only reflects the conversion
+    s3 = LocalS3(root)
+    activities = _LocalDataTransActivities(s3)
+    env = ActivityEnvironment()
+    start = time.perf_counter()
+    page = env.run(
+        activities.get_object_keys, GetObjectKeysActivityInput("export", prefix)
+    )
+    output_files = 0
+    for key, etag in zip(page.keys, page.etags):
+        output_files += env.run(
+            activities.data_trans_and_land,
+            DataTransAndLandActivityInput(
+                "export",
+                key,
+                "output",
+                "parquet",
+                row_group_size=row_group_size,
+                object_etag=etag,
+            ),
+        ).landed_files
+    seconds = time.perf_counter() - start
+    return {
+        "seconds": seconds,
+        "output_files": output_files,
+        "output_bytes": sum(
+            os.path.getsize(os.path.join(dirpath, name))
+            for dirpath, _, names in os.walk(os.path.join(root, "output"))
+            for name in names
+            if name.endswith(".parquet")
+        ),
+        "peak_rss_bytes": _peak_rss_bytes(),
+    }
+
+
+def run_benchmark(
+    files: int,
+    histories: int,
+    activities: int,
+    payload_bytes: int,
+    row_group_size: int = 100_000,
+    work_dir: Optional[str] = None,
+) -> BenchmarkResult:
+    """Function that generates export files and times their conversion."""
+    with tempfile.TemporaryDirectory(dir=work_dir) as root:
+        s3 = LocalS3(root)
+        prefix = "temporal-workflow-history/export/benchmark"
+        events = 0
+        input_bytes = 0
+        for i in range(files):
+            wfs = make_workflow_executions(histories, activities, payload_bytes, i)
+            events += sum(len(wf.history.events) for wf in wfs.items)
+            data = wfs.SerializeToString()
+            input_bytes += len(data)
+            s3.put_object(Bucket="export", Key=f"{prefix}/{i:05}", Body=data)
+        # Spawned rather than forked, since a forked process starts with the
+        # parent's resident pages, which would count towards its peak RSS
+        with ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            stats = executor.submit(_convert, root, prefix, row_group_size).result()
+    return BenchmarkResult(
+        files=files,
+        events=events,
+        input_bytes=input_bytes,
+        output_bytes=stats["output_bytes"],
+        output_files=stats["output_files"],
+        seconds=stats["seconds"],
+        events_per_sec=events / stats["seconds"],
+        peak_rss_bytes=stats["peak_rss_bytes"],
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark proto to parquet")
+    parser.add_argument("--files", type=int, default=4, help="Export files")
+    parser.add_argument(
+        "--histories", type=int, default=500, help="Histories per export file"
+    )
+    parser.add_argument(
+        "--activities", type=int, default=10, help="Activities per history"
+    )
+    parser.add_argument(
+        "--payload-bytes", type=int, default=256, help="Size of each payload"
+    )
+    parser.add_argument("--row-group-size", type=int, default=100_000)
+    parser.add_argument(
+        "--work-dir", help="Directory for the local S3 stand-in, defaults to tmp"
+    )
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    parser.add_argument(
+        "--min-events-per-sec",
+        type=float,
+        help="Exit with an error if throughput is below this",
+    )
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        args.files,
+        args.histories,
+        args.activities,
+        args.payload_bytes,
+        args.row_group_size,
+        args.work_dir,
+    )
+    if args.json:
+        print(json.dumps(asdict(result)))
+    else:
+        peak_rss = "n/a"
+        if result.peak_rss_bytes is not None:
+            peak_rss = f"{result.peak_rss_bytes / 1e6:.1f} MB"
+        print(
+            f"Converted {result.events} events from {result.files} files "
+            f"({result.input_bytes / 1e6:.1f} MB) in {result.seconds:.2f}s\n"
+            f"  events/sec:    {result.events_per_sec:,.0f}\n"
+            f"  peak RSS:      {peak_rss}\n"
+            f"  bytes written: {result.output_bytes / 1e6:.1f} MB "
+            f"in {result.output_files} files"
+        )
+    if args.min_events_per_sec and result.events_per_sec < args.min_events_per_sec:
+        sys.exit(
+            f"Throughput {result.events_per_sec:,.0f} events/sec is below "
+            f"{args.min_events_per_sec:,.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
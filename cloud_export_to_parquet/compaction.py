@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, Iterator, List
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from temporalio import activity
+
+from cloud_export_to_parquet.parquet_sink import S3MultipartUpload
+
+MANIFEST_NAME = "_manifest.json"
+
+# S3 DeleteObjects accepts at most this many keys per request
+_DELETE_BATCH_SIZE = 1000
+
+
+def iter_objects(s3: Any, bucket: str, prefix: str) -> Iterator[Dict[str, Any]]:
+    """Function that lazily lists objects, with their sizes, under a prefix."""
+    kwargs: Dict[str, Any] = {"Bucket": bucket, "Prefix": prefix}
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        yield from response.get("Contents", [])
+        if not response.get("IsTruncated"):
+            return
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def find_partitions(s3: Any, bucket: str, path: str) -> List[str]:
+    """Function that finds the leaf partitions holding parquet files."""
+    partitions = set()
+    for obj in iter_objects(s3, bucket, path):
+        partition, _, name = obj["Key"].rpartition("/")
+        if name.endswith(".parquet"):
+            partitions.add(partition)
+    return sorted(partitions)
+
+
+def plan_compaction(
+    objects: List[Dict[str, Any]], target_file_bytes: int
+) -> List[List[Dict[str, Any]]]:
+    """Group files smaller than the target into runs of about the target size.
+
+    Groups of a single file are dropped, since there is nothing to merge.
+    """
+    groups: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    current_bytes = 0
+    for obj in sorted(objects, key=lambda o: o["Key"]):
+        if obj["Size"] >= target_file_bytes:
+            continue
+        if current and current_bytes + obj["Size"] > target_file_bytes:
+            groups.append(current)
+            current, current_bytes = [], 0
+        current.append(obj)
+        current_bytes += obj["Size"]
+    if current:
+        groups.append(current)
+    return [group for group in groups if len(group) > 1]
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    # Add the columns a file never had and promote the rest, e.g. when files
+    # written with different schema versions are merged
+    columns = [
+        table.column(field.name).cast(field.type)
+        if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def merge_parquet_files(
+    s3: Any,
+    bucket: str,
+    keys: List[str],
+    upload: S3MultipartUpload,
+    row_group_size: int,
+) -> int:
+    """Function that merges parquet files into a single upload.
+
+    Sources are downloaded to local temporary files rather than memory, and
+    their small row groups are coalesced into row groups of row_group_size.
+    Returns the number of rows written.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for index, key in enumerate(keys):
+            path = os.path.join(tmp, f"{index}.parquet")
+            with open(path, "wb") as f:
+                shutil.copyfileobj(s3.get_object(Bucket=bucket, Key=key)["Body"], f)
+            files.append(pq.ParquetFile(path))
+        schema = pa.unify_schemas(
+            [f.schema_arrow for f in files], promote_options="permissive"
+        )
+        num_rows = 0
+        with pq.ParquetWriter(upload, schema, compression="snappy") as writer:
+            pending: List[pa.Table] = []
+            pending_rows = 0
+            for f in files:
+                for batch in f.iter_batches(batch_size=row_group_size):
+                    pending.append(
+                        conform_table(pa.Table.from_batches([batch]), schema)
+                    )
+                    pending_rows += batch.num_rows
+                    if pending_rows >= row_group_size:
+                        writer.write_table(
+                            pa.concat_tables(pending), row_group_size=row_group_size
+                        )
+                        num_rows += pending_rows
+                        pending, pending_rows = [], 0
+                activity.heartbeat()
+            if pending:
+                writer.write_table(pa.concat_tables(pending))
+                num_rows += pending_rows
+    upload.complete()
+    return num_rows
+
+
+def delete_objects(s3: Any, bucket: str, keys: List[str]) -> None:
+    for start in range(0, len(keys), _DELETE_BATCH_SIZE):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [
+                    {"Key": key} for key in keys[start : start + _DELETE_BATCH_SIZE]
+                ],
+                "Quiet": True,
+            },
+        )
+
+
+def compact_partition(
+    s3: Any,
+    bucket: str,
+    partition: str,
+    target_file_bytes: int,
+    row_group_size: int,
+) -> str:
+    """Function that merges the small files of a partition.
+
+    The partition's manifest records each compacted file and its sources
+    before the file is written, and sources are only deleted once it is. A
+    rerun therefore finishes whatever a previous attempt started: compacted
+    files are named after a hash of their sources, missing ones are rewritten
+    under the same key and leftover sources are deleted, so rows are never
+    duplicated or lost.
+    """
+    prefix = f"{partition}/"
+    manifest_key = prefix + MANIFEST_NAME
+    objects = {obj["Key"]: obj for obj in iter_objects(s3, bucket, prefix)}
+    files: List[Dict[str, Any]] = []
+    if manifest_key in objects:
+        files = json.loads(
+            s3.get_object(Bucket=bucket, Key=manifest_key)["Body"].read()
+        )["files"]
+
+    # Files named by the manifest are either merged already or about to be
+    claimed = {file["key"] for file in files}
+    claimed.update(source for file in files for source in file["sources"])
+    candidates = [
+        obj
+        for key, obj in objects.items()
+        if key.endswith(".parquet")
+        and "/" not in key[len(prefix) :]
+        and key not in claimed
+    ]
+    planned = []
+    for group in plan_compaction(candidates, target_file_bytes):
+        sources = [obj["Key"] for obj in group]
+        digest = hashlib.sha256("\n".join(sources).encode("utf-8")).hexdigest()
+        planned.append(
+            {
+                "key": f"{prefix}compacted-{digest[:16]}.parquet",
+                "rows": None,
+                "bytes": None,
+                "sources": sources,
+            }
+        )
+    if planned:
+        files.extend(planned)
+        _put_manifest(s3, bucket, manifest_key, partition, files)
+
+    for file in files:
+        if file["key"] in objects:
+            continue
+        activity.logger.info(
+            "Compacting %s files into %s", len(file["sources"]), file["key"]
+        )
+        upload = S3MultipartUpload(s3, bucket, file["key"])
+        try:
+            file["rows"] = merge_parquet_files(
+                s3, bucket, file["sources"], upload, row_group_size
+            )
+        except Exception:
+            upload.abort()
+            raise
+        file["bytes"] = upload.size
+        objects[file["key"]] = {"Key": file["key"], "Size": upload.size}
+    _put_manifest(s3, bucket, manifest_key, partition, files)
+
+    delete_objects(
+        s3,
+        bucket,
+        sorted(
+            source for file in files for source in file["sources"] if source in objects
+        ),
+    )
+    return manifest_key
+
+
+def _put_manifest(
+    s3: Any, bucket: str, key: str, partition: str, files: List[Dict[str, Any]]
+) -> None:
+    body = json.dumps({"partition": partition, "files": files}, indent=2)
+    s3.put_object(Bucket=bucket, Key=key, Body=body.encode("utf-8"))
@@ -27,6 +27,9 @@ async def main() -> None:
         export_s3_bucket="test-input-bucket",
         namespace="test.namespace",
         output_s3_bucket="test-output-bucket",
+        max_parallel_files=10,
+        conversion_task_queue="DATA_CONVERSION_TASK_QUEUE",
+        compact_after_landing=True,
     )
 
     # Run the workflow
@@ -1,19 +1,67 @@
+import hashlib
 import json
-import uuid
-from dataclasses import dataclass
-from typing import List
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
 import boto3
-import pandas as pd
 import temporalio.api.export.v1 as export
-from google.protobuf.json_format import MessageToJson
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from temporalio import activity
+from temporalio.exceptions import ApplicationError
+
+from cloud_export_to_parquet.compaction import compact_partition, find_partitions
+from cloud_export_to_parquet.export_reader import (
+    download_object,
+    iter_serialized_workflow_executions,
+)
+from cloud_export_to_parquet.flatten import flatten_serialized_histories
+from cloud_export_to_parquet.parquet_sink import (
+    PartitionedParquetWriter,
+    S3MultipartUpload,
+)
+from cloud_export_to_parquet.schema import (
+    schema_registry,
+    schema_version,
+    validate_projection,
+)
 
 
 @dataclass
 class GetObjectKeysActivityInput:
     bucket: str
     path: str
+    # List keys strictly after this one, used to resume from a previous page
+    start_after: Optional[str] = None
+    page_size: int = 1000
+
+
+@dataclass
+class ObjectKeysPage:
+    keys: List[str]
+    # Cursor for the next page, or None if this is the last page
+    next_start_after: Optional[str] = None
+    # ETag of each key, a hash of the object's content
+    etags: List[str] = field(default_factory=list)
+
+
+@dataclass
+class RegisterSchemaActivityInput:
+    bucket: str
+    path: str
 
 
 @dataclass
@@ -22,102 +70,422 @@ class DataTransAndLandActivityInput:
     object_key: str
     output_s3_bucket: str
     write_path: str
+    # Rows per parquet row group, and roughly how much flattened data may be
+    # buffered in memory before a row group is flushed
+    row_group_size: int = 100_000
+    max_buffer_bytes: int = 64 * 1024 * 1024
+    # Rows per set of output files (one per event type). Each landed set is a
+    # checkpoint that retries resume from.
+    max_rows_per_file: int = 1_000_000
+    # Only export these event types (e.g. ACTIVITY_TASK_FAILED) and columns,
+    # all of them if unset
+    event_types: Optional[List[str]] = None
+    columns: Optional[List[str]] = None
+    # ETag of the export object as listed, fetched with a HEAD request if unset
+    object_etag: Optional[str] = None
 
 
-@activity.defn
-def get_object_keys(activity_input: GetObjectKeysActivityInput) -> List[str]:
-    """Function that list objects by key."""
-    object_keys = []
-    s3 = boto3.client("s3")
-    response = s3.list_objects_v2(
-        Bucket=activity_input.bucket, Prefix=activity_input.path
-    )
-    for obj in response.get("Contents", []):
-        object_keys.append(obj["Key"])
-    if len(object_keys) == 0:
-        raise FileNotFoundError(
-            f"No files found in {activity_input.bucket}/{activity_input.path}"
+@dataclass
+class DataTransAndLandResult:
+    # Number of parquet files landed. Their keys are recorded in the object's
+    # marker rather than returned, to keep them out of workflow history.
+    landed_files: int
+    # Whether an earlier run had already landed the object
+    already_landed: bool = False
+
+
+@dataclass
+class DataTransAndLandCheckpoint:
+    """Progress of data_trans_and_land, recorded in its heartbeat details."""
+
+    histories_processed: int = 0
+    keys: List[str] = field(default_factory=list)
+    # Number of landed sets of files, which numbers the next set
+    file_sets: int = 0
+    # Multipart uploads of the files currently being written, as Key and
+    # UploadId, so a retry can abort them
+    uploads: List[Dict[str, Any]] = field(default_factory=list)
+
+
+@dataclass
+class GetPartitionsActivityInput:
+    bucket: str
+    path: str
+
+
+@dataclass
+class CompactPartitionActivityInput:
+    bucket: str
+    partition: str
+    # Files smaller than this are merged into files of about this size
+    target_file_bytes: int = 128 * 1024 * 1024
+    row_group_size: int = 100_000
+
+
+# How often to heartbeat while flattening, between landed files
+HEARTBEAT_EVERY_HISTORIES = 100
+
+# Serialized bytes of the histories flattened per batch in the conversion
+# executor, and how many batches an activity keeps in flight there
+CONVERSION_BATCH_BYTES = 4 * 1024 * 1024
+CONVERSION_BATCHES_IN_FLIGHT = 2
+
+
+def iter_object_key_pages(
+    s3: Any,
+    bucket: str,
+    prefix: str,
+    start_after: Optional[str] = None,
+    page_size: int = 1000,
+) -> Iterator[ObjectKeysPage]:
+    """Function that lazily lists object keys one page at a time."""
+    kwargs: Dict[str, Any] = {"Bucket": bucket, "Prefix": prefix, "MaxKeys": page_size}
+    if start_after:
+        kwargs["StartAfter"] = start_after
+    while True:
+        response = s3.list_objects_v2(**kwargs)
+        contents = response.get("Contents", [])
+        keys = [obj["Key"] for obj in contents]
+        etags = [obj["ETag"] for obj in contents]
+        if not response.get("IsTruncated") or not keys:
+            yield ObjectKeysPage(keys, etags=etags)
+            return
+        yield ObjectKeysPage(keys, keys[-1], etags)
+        kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+_s3_clients: Dict[int, Any] = {}
+_s3_clients_lock = threading.Lock()
+
+
+def _s3_client(max_pool_connections: int) -> Any:
+    # boto3 clients are thread safe once created, but creating them from the
+    # shared default session is not, so they are created under a lock. One
+    # client is kept per process (activity processes each get their own) so
+    # that all activities share its connection pool.
+    with _s3_clients_lock:
+        client = _s3_clients.get(max_pool_connections)
+        if client is None:
+            client = boto3.client(
+                "s3", config=Config(max_pool_connections=max_pool_connections)
+            )
+            _s3_clients[max_pool_connections] = client
+        return client
+
+
+class DataTransActivities:
+    def __init__(
+        self,
+        max_pool_connections: int = 100,
+        conversion_executor: Optional[Executor] = None,
+    ) -> None:
+        # Should be at least the number of activities running concurrently
+        self.max_pool_connections = max_pool_connections
+        # Protobuf parsing and flattening are CPU bound and hold the GIL, so
+        # they can be run in a process pool. S3 I/O stays on the activity's
+        # thread either way.
+        self.conversion_executor = conversion_executor
+
+    @property
+    def s3(self) -> Any:
+        return _s3_client(self.max_pool_connections)
+
+    @activity.defn
+    def get_object_keys(
+        self, activity_input: GetObjectKeysActivityInput
+    ) -> ObjectKeysPage:
+        """Function that list a page of objects by key."""
+        page = next(
+            iter_object_key_pages(
+                self.s3,
+                activity_input.bucket,
+                activity_input.path,
+                activity_input.start_after,
+                activity_input.page_size,
+            )
         )
+        if not page.keys and not activity_input.start_after:
+            raise FileNotFoundError(
+                f"No files found in {activity_input.bucket}/{activity_input.path}"
+            )
 
-    return object_keys
+        return page
 
+    @activity.defn
+    def register_schema(self, activity_input: RegisterSchemaActivityInput) -> str:
+        """Function that persist the versioned event type schemas."""
+        registry = schema_registry()
+        key = f"{activity_input.path}/_schemas/{registry['version']}.json"
+        self.s3.put_object(
+            Bucket=activity_input.bucket,
+            Key=key,
+            Body=json.dumps(registry, indent=2).encode("utf-8"),
+        )
+        return key
 
-@activity.defn
-def data_trans_and_land(activity_input: DataTransAndLandActivityInput) -> str:
-    """Function that convert proto to parquet and save to S3."""
-    key = activity_input.object_key
-    data = get_data_from_object_key(activity_input.export_s3_bucket, key)
-    activity.logger.info("Convert proto to parquet for file: %s", key)
-    parquet_data = convert_proto_to_parquet_flatten(data)
-    activity.logger.info("Finish transformation for file: %s", key)
-    return save_to_sink(
-        parquet_data, activity_input.output_s3_bucket, activity_input.write_path
-    )
+    @activity.defn
+    def get_partitions(self, activity_input: GetPartitionsActivityInput) -> List[str]:
+        """Function that list the partitions holding parquet files."""
+        return find_partitions(self.s3, activity_input.bucket, activity_input.path)
 
+    @activity.defn
+    def compact_partition(self, activity_input: CompactPartitionActivityInput) -> str:
+        """Function that merge the small parquet files of a partition."""
+        return compact_partition(
+            self.s3,
+            activity_input.bucket,
+            activity_input.partition,
+            activity_input.target_file_bytes,
+            activity_input.row_group_size,
+        )
 
-def get_data_from_object_key(
-    bucket_name: str, object_key: str
-) -> export.WorkflowExecutions:
-    """Function that get object by key."""
-    v = export.WorkflowExecutions()
+    @activity.defn
+    def data_trans_and_land(
+        self, activity_input: DataTransAndLandActivityInput
+    ) -> DataTransAndLandResult:
+        """Function that convert proto to parquet and save to S3.
 
-    s3 = boto3.client("s3")
-    try:
-        data = s3.get_object(Bucket=bucket_name, Key=object_key)["Body"].read()
-    except Exception as e:
-        activity.logger.error(f"Error reading object: {e}")
-        raise e
-    v.ParseFromString(data)
-    return v
-
-
-def convert_proto_to_parquet_flatten(wfs: export.WorkflowExecutions) -> pd.DataFrame:
-    """Function that convert flatten proto data to parquet."""
-    dfs = []
-    for wf in wfs.items:
-        start_attributes = wf.history.events[
-            0
-        ].workflow_execution_started_event_attributes
-        histories = wf.history
-        json_str = MessageToJson(histories)
-        row = {
-            "WorkflowID": start_attributes.workflow_id,
-            "RunID": start_attributes.original_execution_run_id,
-            "Histories": json.loads(json_str),
-        }
-        dfs.append(pd.DataFrame([row]))
-    df = pd.concat(dfs, ignore_index=True)
-    rows_flatten = []
-    for _, row in df.iterrows():
-        wf_histories_raw = row["Histories"]["events"]
-        worfkow_id = row["WorkflowID"]
-        run_id = row["RunID"]
-        for history_event in wf_histories_raw:
-            row_flatten = pd.json_normalize(history_event, sep="_")
-            skip_name = ["payloads", "."]
-            columns_to_drop = [
-                col for col in row_flatten.columns for skip in skip_name if skip in col
+        Output keys are derived from the export object, its content and the
+        conversion settings, and a marker listing them is written once all of
+        them landed. Converting an object that already landed only costs a
+        HEAD request of its marker.
+        """
+        key = activity_input.object_key
+        try:
+            validate_projection(activity_input.event_types, activity_input.columns)
+        except ValueError as e:
+            raise ApplicationError(str(e), non_retryable=True) from e
+        etag = activity_input.object_etag
+        if etag is None:
+            etag = self.s3.head_object(Bucket=activity_input.export_s3_bucket, Key=key)[
+                "ETag"
             ]
-            row_flatten.drop(columns_to_drop, axis=1, inplace=True)
-            row_flatten.insert(0, "WorkflowId", worfkow_id)
-            row_flatten.insert(1, "RunId", run_id)
-            rows_flatten.append(row_flatten)
-    df_flatten = pd.concat(rows_flatten, ignore_index=True)
-    return df_flatten
-
-
-def save_to_sink(data: pd.DataFrame, s3_bucket: str, write_path: str) -> str:
-    """Function that save object to s3 bucket."""
-    write_bytes = data.to_parquet(None, compression="snappy", index=False)
-    uuid_name = uuid.uuid1()
-    file_name = f"{uuid_name}.parquet"
-    activity.logger.info("Writing to S3 bucket: %s", file_name)
-
-    s3 = boto3.client("s3")
+        output_name = get_output_name(activity_input, etag)
+        marker_key = f"{activity_input.write_path}/_landed/{output_name}.json"
+        if object_exists(self.s3, activity_input.output_s3_bucket, marker_key):
+            activity.logger.info("Skipping %s, already landed", key)
+            return DataTransAndLandResult(0, already_landed=True)
+        checkpoint = DataTransAndLandCheckpoint()
+        heartbeat_details = activity.info().heartbeat_details
+        if heartbeat_details:
+            # Resume after the files a previous attempt already landed. Its
+            # in-progress files can't be resumed, since parquet footers describe
+            # every row group, so their multipart uploads are aborted instead.
+            checkpoint = DataTransAndLandCheckpoint(**heartbeat_details[0])
+            activity.logger.info(
+                "Resuming %s after %s histories",
+                key,
+                checkpoint.histories_processed,
+            )
+            for upload in checkpoint.uploads:
+                abort_upload(
+                    self.s3,
+                    activity_input.output_s3_bucket,
+                    upload["Key"],
+                    upload["UploadId"],
+                )
+            checkpoint.uploads = []
+        # The export file is spooled to disk and parsed one history at a time,
+        # so memory is bounded by the largest history rather than the file
+        with download_object(self.s3, activity_input.export_s3_bucket, key) as f:
+            activity.logger.info("Convert proto to parquet for file: %s", key)
+            keys = save_to_sink(
+                self.s3,
+                iter_serialized_workflow_executions(
+                    f, skip=checkpoint.histories_processed
+                ),
+                activity_input,
+                checkpoint,
+                output_name,
+                self.conversion_executor,
+            )
+        self.s3.put_object(
+            Bucket=activity_input.output_s3_bucket,
+            Key=marker_key,
+            Body=json.dumps({"source": key, "etag": etag, "keys": keys}).encode(
+                "utf-8"
+            ),
+        )
+        return DataTransAndLandResult(len(keys))
+
+
+def get_output_name(activity_input: DataTransAndLandActivityInput, etag: str) -> str:
+    """Function that names the output files of an export object.
+
+    The name only changes if the object, its content or anything that changes
+    the output does, so reruns overwrite rather than duplicate.
+    """
+    identity = [
+        activity_input.object_key,
+        etag,
+        schema_version(),
+        sorted(activity_input.event_types or []),
+        sorted(activity_input.columns or []),
+        activity_input.max_rows_per_file,
+    ]
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()[:32]
+
+
+def object_exists(s3: Any, bucket: str, key: str) -> bool:
     try:
-        key = f"{write_path}/{file_name}"
-        s3.put_object(Bucket=s3_bucket, Key=key, Body=write_bytes)
-        return key
+        s3.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+    return True
+
+
+def abort_upload(s3: Any, bucket: str, key: str, upload_id: str) -> None:
+    """Function that aborts a multipart upload, if it wasn't already."""
+    try:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        # The failed attempt usually aborted its uploads itself
+        if e.response["Error"]["Code"] in ("404", "NoSuchUpload"):
+            return
+        raise
+
+
+def save_to_sink(
+    s3: Any,
+    histories: Iterable[bytes],
+    activity_input: DataTransAndLandActivityInput,
+    checkpoint: DataTransAndLandCheckpoint,
+    output_name: str,
+    conversion_executor: Optional[Executor] = None,
+) -> List[str]:
+    """Function that stream serialized histories as parquet files to s3 bucket.
+
+    Events are written to one file per event type under a Hive-style
+    ``event_type=`` partition of the write path. A new set of files is started
+    every max_rows_per_file rows, and the checkpoint is heartbeated as each set
+    lands so a retry can skip the landed histories. The histories are those
+    after the checkpoint's histories_processed. If a conversion executor is
+    given, histories are parsed and flattened there in batches, while this
+    thread writes and uploads the previous batches.
+    """
+    writer: Optional[PartitionedParquetWriter] = None
+
+    def on_part(_: S3MultipartUpload) -> None:
+        assert writer
+        checkpoint.uploads = [
+            {"Key": upload.key, "UploadId": upload.upload_id}
+            for upload in writer.uploads
+            if upload.upload_id
+        ]
+        activity.heartbeat(checkpoint)
+
+    def open_upload(event_type: str) -> S3MultipartUpload:
+        file_name = f"{output_name}-{checkpoint.file_sets:05}.parquet"
+        key = f"{activity_input.write_path}/event_type={event_type}/{file_name}"
+        activity.logger.info("Writing to S3 bucket: %s", key)
+        return S3MultipartUpload(
+            s3, activity_input.output_s3_bucket, key, on_part=on_part
+        )
+
+    event_types = _frozenset_or_none(activity_input.event_types)
+    columns = _frozenset_or_none(activity_input.columns)
+    batches: Iterator[Tuple[int, Any]] = (
+        ((1, export.WorkflowExecution.FromString(h)) for h in histories)
+        if conversion_executor is None
+        else _flatten_in_executor(conversion_executor, histories, event_types, columns)
+    )
+    pending_histories = 0
+    unreported_histories = 0
+    try:
+        for num_histories, batch in batches:
+            if writer is None:
+                writer = PartitionedParquetWriter(
+                    open_upload,
+                    activity_input.row_group_size,
+                    activity_input.max_buffer_bytes,
+                    event_types,
+                    columns,
+                )
+            if conversion_executor is None:
+                writer.write_history(batch)
+            else:
+                writer.write_tables(batch)
+            pending_histories += num_histories
+            unreported_histories += num_histories
+            if writer.num_rows >= activity_input.max_rows_per_file:
+                _land(writer, checkpoint, pending_histories)
+                writer, pending_histories, unreported_histories = None, 0, 0
+            elif unreported_histories >= HEARTBEAT_EVERY_HISTORIES:
+                activity.heartbeat(checkpoint)
+                unreported_histories = 0
+        if writer is not None:
+            _land(writer, checkpoint, pending_histories)
+        return checkpoint.keys
     except Exception as e:
         activity.logger.error(f"Error saving to sink: {e}")
+        if writer is not None:
+            writer.abort()
+            # So the retry doesn't abort them again
+            checkpoint.uploads = []
+            activity.heartbeat(checkpoint)
         raise e
+
+
+def _flatten_in_executor(
+    executor: Executor,
+    histories: Iterable[bytes],
+    event_types: Optional[FrozenSet[str]],
+    columns: Optional[FrozenSet[str]],
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    # Yields the number of histories and their tables of each batch, in order,
+    # keeping the next batches in flight so the executor stays busy
+    in_flight: Deque[Tuple[int, "Future[Dict[str, Any]]"]] = deque()
+
+    def submit(batch: List[bytes]) -> None:
+        in_flight.append(
+            (
+                len(batch),
+                executor.submit(
+                    flatten_serialized_histories, batch, event_types, columns
+                ),
+            )
+        )
+
+    try:
+        batch: List[bytes] = []
+        batch_bytes = 0
+        for history in histories:
+            batch.append(history)
+            batch_bytes += len(history)
+            if batch_bytes < CONVERSION_BATCH_BYTES:
+                continue
+            submit(batch)
+            batch, batch_bytes = [], 0
+            if len(in_flight) > CONVERSION_BATCHES_IN_FLIGHT:
+                num_histories, future = in_flight.popleft()
+                yield num_histories, future.result()
+        if batch:
+            submit(batch)
+        while in_flight:
+            num_histories, future = in_flight.popleft()
+            yield num_histories, future.result()
+    finally:
+        for _, future in in_flight:
+            future.cancel()
+
+
+def _frozenset_or_none(values: Optional[List[str]]) -> Optional[FrozenSet[str]]:
+    return frozenset(values) if values is not None else None
+
+
+def _land(
+    writer: PartitionedParquetWriter,
+    checkpoint: DataTransAndLandCheckpoint,
+    histories: int,
+) -> None:
+    keys = writer.close()
+    activity.logger.info(
+        "Finish transformation of %s rows to %s files", writer.num_rows, len(keys)
+    )
+    checkpoint.histories_processed += histories
+    checkpoint.keys.extend(keys)
+    checkpoint.file_sets += 1
+    checkpoint.uploads = []
+    activity.heartbeat(checkpoint)
@@ -0,0 +1,96 @@
+import mmap
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Any, Iterator, Tuple
+
+import temporalio.api.export.v1 as export
+
+# Field number of WorkflowExecutions.items
+_ITEMS_FIELD_NUMBER = 1
+
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+# Size of the chunks the S3 body is copied in
+_CHUNK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def download_object(s3: Any, bucket: str, key: str) -> Iterator[IO[bytes]]:
+    """Function that streams an object to a temporary file.
+
+    The body is copied in fixed-size chunks, so it is never held in memory as
+    a whole. The file is removed on exit.
+    """
+    with tempfile.TemporaryFile() as f:
+        shutil.copyfileobj(
+            s3.get_object(Bucket=bucket, Key=key)["Body"], f, _CHUNK_SIZE
+        )
+        f.flush()
+        yield f
+
+
+def _read_varint(buffer: Any, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buffer):
+            raise ValueError("Truncated varint")
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def iter_workflow_executions(
+    f: IO[bytes], skip: int = 0
+) -> Iterator[export.WorkflowExecution]:
+    """Function that parses a serialized WorkflowExecutions one item at a time.
+
+    Only one history is parsed and held at a time, rather than the file's
+    bytes and every parsed history at once. The first ``skip`` items are
+    stepped over without being parsed.
+    """
+    for data in iter_serialized_workflow_executions(f, skip):
+        yield export.WorkflowExecution.FromString(data)
+
+
+def iter_serialized_workflow_executions(f: IO[bytes], skip: int = 0) -> Iterator[bytes]:
+    """Function that yields the serialized items of a WorkflowExecutions.
+
+    The file is memory-mapped and its top-level fields are walked in the
+    protobuf wire format, so items are found without parsing anything else.
+    The first ``skip`` items are stepped over.
+    """
+    f.seek(0, 2)
+    if not f.tell():
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        pos = 0
+        index = 0
+        while pos < len(buffer):
+            tag, pos = _read_varint(buffer, pos)
+            field_number, wire_type = tag >> 3, tag & 0x7
+            if wire_type == _WIRE_VARINT:
+                _, pos = _read_varint(buffer, pos)
+            elif wire_type == _WIRE_FIXED64:
+                pos += 8
+            elif wire_type == _WIRE_FIXED32:
+                pos += 4
+            elif wire_type == _WIRE_LENGTH_DELIMITED:
+                length, pos = _read_varint(buffer, pos)
+                end = pos + length
+                if end > len(buffer):
+                    raise ValueError("Truncated WorkflowExecutions")
+                if field_number == _ITEMS_FIELD_NUMBER:
+                    if index >= skip:
+                        yield buffer[pos:end]
+                    index += 1
+                pos = end
+            else:
+                raise ValueError(f"Unsupported wire type {wire_type}")
@@ -0,0 +1,154 @@
+import hashlib
+import os
+import tempfile
+import uuid
+from typing import IO, Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+
+class LocalS3:
+    """Filesystem-backed stand-in for the parts of the S3 client used here.
+
+    Used by the offline benchmark and the tests. Objects are stored as files
+    under ``root/<bucket>/<key>``, and the name of every call is recorded in
+    ``calls``.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.calls: List[str] = []
+        self._uploads: Dict[str, str] = {}
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def _keys(self, bucket: str) -> List[str]:
+        bucket_root = os.path.join(self.root, bucket)
+        keys = []
+        for dirpath, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename), bucket_root)
+                keys.append(key.replace(os.sep, "/"))
+        return sorted(keys)
+
+    def objects(self, bucket: str) -> Dict[str, bytes]:
+        """Content of every object of a bucket, by key."""
+        objects = {}
+        for key in self._keys(bucket):
+            with open(self._path(bucket, key), "rb") as f:
+                objects[key] = f.read()
+        return objects
+
+    def list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str,
+        MaxKeys: int = 1000,
+        StartAfter: str = "",
+        ContinuationToken: str = "",
+    ) -> Dict[str, Any]:
+        self.calls.append("list_objects_v2")
+        keys = [
+            key
+            for key in self._keys(Bucket)
+            if key.startswith(Prefix) and key > (ContinuationToken or StartAfter)
+        ]
+        page = keys[:MaxKeys]
+        response: Dict[str, Any] = {
+            "Contents": [self._head(Bucket, key) for key in page],
+            "IsTruncated": len(keys) > MaxKeys,
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+    def _head(self, bucket: str, key: str) -> Dict[str, Any]:
+        # Objects are not immutable here, so the ETag is a hash of the stat
+        stat = os.stat(self._path(bucket, key))
+        etag = hashlib.md5(f"{stat.st_size}-{stat.st_mtime_ns}".encode()).hexdigest()
+        return {"Key": key, "Size": stat.st_size, "ETag": f'"{etag}"'}
+
+    def head_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        self.calls.append("head_object")
+        if not os.path.exists(self._path(Bucket, Key)):
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return self._head(Bucket, Key)
+
+    def get_object(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        self.calls.append("get_object")
+        if not os.path.exists(self._path(Bucket, Key)):
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": _Body(open(self._path(Bucket, Key), "rb"))}
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes) -> None:
+        self.calls.append("put_object")
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(Body)
+
+    def delete_objects(self, Bucket: str, Delete: Dict[str, Any]) -> None:
+        self.calls.append("delete_objects")
+        for obj in Delete["Objects"]:
+            path = self._path(Bucket, obj["Key"])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def create_multipart_upload(self, Bucket: str, Key: str) -> Dict[str, Any]:
+        self.calls.append("create_multipart_upload")
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = tempfile.mkdtemp(dir=self.root)
+        return {"UploadId": upload_id}
+
+    def upload_part(
+        self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes
+    ) -> Dict[str, Any]:
+        self.calls.append("upload_part")
+        with open(os.path.join(self._uploads[UploadId], str(PartNumber)), "wb") as f:
+            f.write(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: Dict[str, Any]
+    ) -> None:
+        self.calls.append("complete_multipart_upload")
+        parts_dir = self._uploads.pop(UploadId)
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            for part in MultipartUpload["Parts"]:
+                part_path = os.path.join(parts_dir, str(part["PartNumber"]))
+                with open(part_path, "rb") as part_file:
+                    f.write(part_file.read())
+                os.remove(part_path)
+        os.rmdir(parts_dir)
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str) -> None:
+        self.calls.append("abort_multipart_upload")
+        if UploadId not in self._uploads:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchUpload"}}, "AbortMultipartUpload"
+            )
+        parts_dir = self._uploads.pop(UploadId)
+        for name in os.listdir(parts_dir):
+            os.remove(os.path.join(parts_dir, name))
+        os.rmdir(parts_dir)
+
+
+class _Body:
+    # Like botocore's StreamingBody, which releases its connection once read
+    # to the end, the file is closed at the end or when the body is closed
+    def __init__(self, f: IO[bytes]) -> None:
+        self._f = f
+
+    def read(self, amt: Optional[int] = None) -> bytes:
+        if self._f.closed:
+            return b""
+        chunk = self._f.read() if amt is None else self._f.read(amt)
+        if not chunk or amt is None:
+            self.close()
+        return chunk
+
+    def close(self) -> None:
+        self._f.close()
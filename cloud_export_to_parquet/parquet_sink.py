@@ -0,0 +1,256 @@
+import io
+import tempfile
+from typing import IO, Any, Callable, Dict, FrozenSet, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import temporalio.api.export.v1 as export
+
+from cloud_export_to_parquet.flatten import ColumnBuilder, iter_event_rows
+from cloud_export_to_parquet.schema import (
+    SCHEMA_VERSION_METADATA_KEY,
+    event_plan,
+    schema_version,
+)
+
+# S3 rejects multipart parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartUpload(io.RawIOBase):
+    """Write-only stream that uploads to S3 one multipart part at a time.
+
+    Data is buffered in a temporary file until a part is full, so a writer
+    with many open uploads (one per event type) doesn't hold a part of each in
+    memory. Only the part being uploaded is read into memory. If the upload is
+    completed before a full part was written, a single put_object is used
+    instead. ``on_part`` is called after each part is uploaded.
+    """
+
+    def __init__(
+        self,
+        s3: Any,
+        bucket: str,
+        key: str,
+        part_size: int = MIN_PART_SIZE,
+        on_part: Optional[Callable[["S3MultipartUpload"], None]] = None,
+    ) -> None:
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.on_part = on_part
+        self.upload_id: Optional[str] = None
+        self.parts: List[Dict[str, Any]] = []
+        # Number of bytes written so far
+        self.size = 0
+        self._spool: Optional[IO[bytes]] = None
+        self._spooled = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        view = memoryview(data)
+        if self._spool is None:
+            self._spool = tempfile.TemporaryFile()
+        self._spool.write(view)
+        self._spooled += view.nbytes
+        self.size += view.nbytes
+        while self._spooled >= self.part_size:
+            self._spool.seek(0)
+            part = self._spool.read(self.part_size)
+            rest = self._spool.read()
+            self._spool.seek(0)
+            self._spool.truncate()
+            self._spool.write(rest)
+            self._spooled = len(rest)
+            self._upload_part(part)
+        return view.nbytes
+
+    def complete(self) -> None:
+        body = self._read_spool()
+        if self.upload_id is None:
+            self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=body)
+        else:
+            if body:
+                self._upload_part(body)
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+            self.upload_id = None
+
+    def abort(self) -> None:
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+            self.upload_id = None
+        self._close_spool()
+
+    def _read_spool(self) -> bytes:
+        # Returns and discards what is buffered
+        if self._spool is None:
+            return b""
+        self._spool.seek(0)
+        body = self._spool.read()
+        self._close_spool()
+        return body
+
+    def _close_spool(self) -> None:
+        if self._spool is not None:
+            self._spool.close()
+        self._spool = None
+        self._spooled = 0
+
+    def _upload_part(self, body: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        if self.on_part:
+            self.on_part(self)
+
+
+class _EventTypeFile:
+    # Buffered rows and tables, and parquet writer of one event type's output
+    # file
+
+    def __init__(
+        self, schema: pa.Schema, upload: S3MultipartUpload, row_group_size: int
+    ) -> None:
+        self.schema = schema
+        self.upload = upload
+        self.row_group_size = row_group_size
+        self.builder = ColumnBuilder()
+        self.tables: List[pa.Table] = []
+        self.writer: Optional[pq.ParquetWriter] = None
+
+    @property
+    def buffered_rows(self) -> int:
+        return self.builder.num_rows + sum(table.num_rows for table in self.tables)
+
+    @property
+    def buffered_bytes(self) -> int:
+        return self.builder.estimated_bytes + sum(t.nbytes for t in self.tables)
+
+    def flush(self) -> None:
+        tables = self.tables
+        if self.builder.num_rows:
+            tables.append(self.builder.to_table(self.schema))
+        if not tables:
+            return
+        table = pa.concat_tables(tables)
+        self.builder = ColumnBuilder()
+        self.tables = []
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.upload, self.schema, compression="snappy"
+            )
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+        self.upload.complete()
+
+
+class PartitionedParquetWriter:
+    """Flattens histories into one parquet file per event type.
+
+    Every event type has a fixed schema, so rows are written as parquet row
+    groups as soon as ``row_group_size`` rows of an event type are buffered,
+    or when roughly ``max_buffer_bytes`` are buffered across all event types
+    (the largest buffer is flushed). Encoded parquet waiting to be uploaded is
+    spooled to disk by :py:class:`S3MultipartUpload`, so ``max_buffer_bytes``
+    bounds the memory used however many event types there are. ``open_upload``
+    is called with the event type to start the upload of each file.
+    ``event_types`` and ``columns`` restrict the events and columns written,
+    as in :py:func:`cloud_export_to_parquet.flatten.iter_event_rows`.
+    """
+
+    def __init__(
+        self,
+        open_upload: Callable[[str], S3MultipartUpload],
+        row_group_size: int = 100_000,
+        max_buffer_bytes: int = 64 * 1024 * 1024,
+        event_types: Optional[FrozenSet[str]] = None,
+        columns: Optional[FrozenSet[str]] = None,
+    ) -> None:
+        self.open_upload = open_upload
+        self.row_group_size = row_group_size
+        self.max_buffer_bytes = max_buffer_bytes
+        self.event_types = event_types
+        self.columns = columns
+        self.num_rows = 0
+        self._files: Dict[str, _EventTypeFile] = {}
+        self._schema_metadata = {SCHEMA_VERSION_METADATA_KEY: schema_version()}
+
+    @property
+    def uploads(self) -> List[S3MultipartUpload]:
+        return [file.upload for file in self._files.values()]
+
+    def write_history(self, wf: export.WorkflowExecution) -> None:
+        for event_type, row in iter_event_rows(wf, self.event_types, self.columns):
+            file = self._file(event_type)
+            file.builder.add_row(row)
+            self.num_rows += 1
+            if file.builder.num_rows >= self.row_group_size:
+                file.flush()
+        self._bound_buffers()
+
+    def write_tables(self, tables: Dict[str, pa.Table]) -> None:
+        """Write histories already flattened into a table per event type.
+
+        The tables must have the schemas of
+        :py:func:`cloud_export_to_parquet.flatten.flatten_serialized_histories`
+        with the same event types and columns.
+        """
+        for event_type, table in tables.items():
+            file = self._file(event_type)
+            file.tables.append(table)
+            self.num_rows += table.num_rows
+            if file.buffered_rows >= self.row_group_size:
+                file.flush()
+        self._bound_buffers()
+
+    def _file(self, event_type: str) -> _EventTypeFile:
+        file = self._files.get(event_type)
+        if file is None:
+            schema = event_plan(event_type, self.columns).schema
+            file = _EventTypeFile(
+                schema.with_metadata(self._schema_metadata),
+                self.open_upload(event_type),
+                self.row_group_size,
+            )
+            self._files[event_type] = file
+        return file
+
+    def _bound_buffers(self) -> None:
+        buffered = [file.buffered_bytes for file in self._files.values()]
+        if sum(buffered) >= self.max_buffer_bytes:
+            max(self._files.values(), key=lambda f: f.buffered_bytes).flush()
+
+    def close(self) -> List[str]:
+        """Finish every file and return their keys."""
+        for file in self._files.values():
+            file.close()
+        return [file.upload.key for file in self._files.values()]
+
+    def abort(self) -> None:
+        for file in self._files.values():
+            file.upload.abort()
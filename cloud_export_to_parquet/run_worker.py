@@ -1,5 +1,8 @@
+import argparse
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
 
 from temporalio.client import Client
 from temporalio.worker import Worker
@@ -8,30 +11,75 @@ from temporalio.worker.workflow_sandbox import (
     SandboxRestrictions,
 )
 
-from cloud_export_to_parquet.data_trans_activities import (
-    data_trans_and_land,
-    get_object_keys,
-)
-from cloud_export_to_parquet.workflows import ProtoToParquet
+from cloud_export_to_parquet.data_trans_activities import DataTransActivities
+from cloud_export_to_parquet.workflows import CompactParquet, ProtoToParquet
 
 
 async def main() -> None:
     """Main worker function."""
+    parser = argparse.ArgumentParser(description="Run worker")
+    parser.add_argument(
+        "--process-pool",
+        action="store_true",
+        help="Parse and flatten histories in a process pool instead of threads",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of conversion processes, defaults to the number of cores",
+    )
+    parser.add_argument(
+        "--max-pool-connections",
+        type=int,
+        default=100,
+        help="Size of the S3 connection pool shared by activities in a process",
+    )
+    args = parser.parse_args()
+
+    # Protobuf parsing and flattening are CPU bound and hold the GIL, so the
+    # conversion activities can instead run them in one process per core.
+    # Their S3 downloads and uploads stay on threads, so they overlap with
+    # the processes' work.
+    conversion_executor: Optional[ProcessPoolExecutor] = None
+    max_concurrent_conversions = 100
+    if args.process_pool:
+        conversion_executor = ProcessPoolExecutor(args.processes)
+        # Each activity keeps a few batches in flight in the pool, so a couple
+        # per process keep every core busy without queueing so much work that
+        # activities wait on the pool for long
+        max_concurrent_conversions = 2 * args.processes
+
     # Create client connected to server at the given address
     client = await Client.connect("localhost:7233")
+    activities = DataTransActivities(args.max_pool_connections, conversion_executor)
 
-    # Run the worker
+    # Workflows and S3 listing are I/O bound, so they stay on threads
     worker: Worker = Worker(
         client,
         task_queue="DATA_TRANSFORMATION_TASK_QUEUE",
-        workflows=[ProtoToParquet],
-        activities=[get_object_keys, data_trans_and_land],
+        workflows=[ProtoToParquet, CompactParquet],
+        activities=[
+            activities.get_object_keys,
+            activities.register_schema,
+            activities.data_trans_and_land,
+            activities.get_partitions,
+            activities.compact_partition,
+        ],
         workflow_runner=SandboxedWorkflowRunner(
             restrictions=SandboxRestrictions.default.with_passthrough_modules("boto3")
         ),
         activity_executor=ThreadPoolExecutor(100),
     )
-    await worker.run()
+
+    conversion_worker: Worker = Worker(
+        client,
+        task_queue="DATA_CONVERSION_TASK_QUEUE",
+        activities=[activities.data_trans_and_land],
+        activity_executor=ThreadPoolExecutor(max_concurrent_conversions),
+        max_concurrent_activities=max_concurrent_conversions,
+    )
+    await asyncio.gather(worker.run(), conversion_worker.run())
 
 
 if __name__ == "__main__":
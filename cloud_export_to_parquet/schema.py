@@ -0,0 +1,340 @@
+import base64
+import hashlib
+import json
+import math
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional
+
+import pyarrow as pa
+from google.protobuf import json_format
+from google.protobuf.descriptor import FieldDescriptor
+from google.protobuf.message import Message
+from temporalio.api.enums.v1 import EventType
+from temporalio.api.history.v1 import HistoryEvent
+
+# Bump whenever the rules below change how columns are derived. The schema
+# version also includes a fingerprint of the derived columns, so upgrading the
+# Temporal API protos to a version with new fields yields a new version too.
+SCHEMA_RULES_VERSION = 1
+
+# Key of the schema version in the key-value metadata of every parquet file
+SCHEMA_VERSION_METADATA_KEY = b"temporal.history.schema_version"
+
+# Payload data is never exported
+_PAYLOAD_TYPES = (
+    "temporal.api.common.v1.Payload",
+    "temporal.api.common.v1.Payloads",
+)
+
+_EVENT_TYPE_PREFIX = "EVENT_TYPE_"
+
+_SCALAR_TYPES = {
+    FieldDescriptor.TYPE_DOUBLE: pa.float64(),
+    FieldDescriptor.TYPE_FLOAT: pa.float32(),
+    FieldDescriptor.TYPE_INT64: pa.int64(),
+    FieldDescriptor.TYPE_SINT64: pa.int64(),
+    FieldDescriptor.TYPE_SFIXED64: pa.int64(),
+    FieldDescriptor.TYPE_UINT64: pa.uint64(),
+    FieldDescriptor.TYPE_FIXED64: pa.uint64(),
+    FieldDescriptor.TYPE_INT32: pa.int32(),
+    FieldDescriptor.TYPE_SINT32: pa.int32(),
+    FieldDescriptor.TYPE_SFIXED32: pa.int32(),
+    FieldDescriptor.TYPE_UINT32: pa.uint32(),
+    FieldDescriptor.TYPE_FIXED32: pa.uint32(),
+    FieldDescriptor.TYPE_BOOL: pa.bool_(),
+    FieldDescriptor.TYPE_STRING: pa.string(),
+    FieldDescriptor.TYPE_BYTES: pa.binary(),
+    FieldDescriptor.TYPE_ENUM: pa.string(),
+}
+
+
+@dataclass
+class FieldPlan:
+    """How to flatten one protobuf field.
+
+    Leaf fields have a column and a converter from the protobuf value to the
+    column's Arrow value. Nested messages have children keyed by field number.
+    """
+
+    column: Optional[str] = None
+    convert: Optional[Callable[[Any], Any]] = None
+    children: Optional[Dict[int, "FieldPlan"]] = None
+
+
+def _is_repeated(field: FieldDescriptor) -> bool:
+    # Newer protobuf releases replace FieldDescriptor.label with is_repeated
+    is_repeated = getattr(field, "is_repeated", None)
+    if is_repeated is not None:
+        return is_repeated
+    # Looked up dynamically, since the newer stubs no longer declare it
+    return getattr(field, "label") == FieldDescriptor.LABEL_REPEATED
+
+
+def _scalar_to_json(field: FieldDescriptor, value: Any) -> Any:
+    # Mirrors the scalar rendering of google.protobuf.json_format
+    if field.type == FieldDescriptor.TYPE_ENUM:
+        enum_value = field.enum_type.values_by_number.get(value)  # type: ignore
+        return enum_value.name if enum_value is not None else value
+    if field.type in (
+        FieldDescriptor.TYPE_INT64,
+        FieldDescriptor.TYPE_SINT64,
+        FieldDescriptor.TYPE_SFIXED64,
+        FieldDescriptor.TYPE_UINT64,
+        FieldDescriptor.TYPE_FIXED64,
+    ):
+        return str(value)
+    if field.type == FieldDescriptor.TYPE_BYTES:
+        return base64.b64encode(value).decode("utf-8")
+    if isinstance(value, float) and not math.isfinite(value):
+        return "NaN" if math.isnan(value) else "Infinity" if value > 0 else "-Infinity"
+    return value
+
+
+def _strip_payloads(message: Message) -> None:
+    # Clears the Payload and Payloads fields of a message, at any depth
+    for field, value in message.ListFields():
+        message_type = field.message_type
+        if message_type is None:
+            continue
+        if message_type.GetOptions().map_entry:
+            value_type = message_type.fields_by_name["value"].message_type
+            if value_type is None:
+                continue
+            if value_type.full_name in _PAYLOAD_TYPES:
+                message.ClearField(field.name)
+            else:
+                for v in value.values():
+                    _strip_payloads(v)
+        elif message_type.full_name in _PAYLOAD_TYPES:
+            message.ClearField(field.name)
+        elif _is_repeated(field):
+            for v in value:
+                _strip_payloads(v)
+        else:
+            _strip_payloads(value)
+
+
+def _message_to_json(value: Message) -> Any:
+    stripped = type(value)()
+    stripped.CopyFrom(value)
+    _strip_payloads(stripped)
+    return json_format.MessageToDict(stripped)
+
+
+def _json_converter(field: FieldDescriptor) -> Callable[[Any], Any]:
+    # Lists, maps and messages without a fixed shape are kept as JSON text,
+    # without the payloads nested in them
+    def to_json_value(field: FieldDescriptor, value: Any) -> Any:
+        if field.message_type is not None:
+            return _message_to_json(value)
+        return _scalar_to_json(field, value)
+
+    if field.message_type is not None and field.message_type.GetOptions().map_entry:
+        key_field = field.message_type.fields_by_name["key"]
+        value_field = field.message_type.fields_by_name["value"]
+        return lambda value: json.dumps(
+            {
+                str(_scalar_to_json(key_field, k)): to_json_value(value_field, v)
+                for k, v in value.items()
+            }
+        )
+    if _is_repeated(field):
+        return lambda value: json.dumps([to_json_value(field, v) for v in value])
+    return lambda value: json.dumps(to_json_value(field, value))
+
+
+def _enum_converter(field: FieldDescriptor) -> Callable[[Any], Any]:
+    names = {v.number: v.name for v in field.enum_type.values}  # type: ignore
+    return lambda value: names.get(value, str(value))
+
+
+def _to_micros(value: Any) -> int:
+    return value.seconds * 1_000_000 + value.nanos // 1000
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def _compile(
+    fields: Iterable[FieldDescriptor],
+    prefix: str,
+    path: FrozenSet[str],
+    columns: List[pa.Field],
+) -> Dict[int, FieldPlan]:
+    # Appends the columns of the given fields and returns how to fill them
+    plan: Dict[int, FieldPlan] = {}
+    for field in fields:
+        name = prefix + field.json_name
+        message_type = field.message_type
+        element_type = message_type
+        if message_type is not None and message_type.GetOptions().map_entry:
+            element_type = message_type.fields_by_name["value"].message_type
+        if element_type is not None and element_type.full_name in _PAYLOAD_TYPES:
+            continue
+        if (
+            _is_repeated(field)
+            or (message_type is not None and message_type.full_name in path)
+            or (
+                message_type is not None
+                and message_type.full_name.startswith("google.protobuf.")
+                and message_type.full_name
+                not in ("google.protobuf.Timestamp", "google.protobuf.Duration")
+            )
+        ):
+            # Lists, maps, recursive messages (e.g. Failure.cause) and dynamic
+            # well-known types (Any, Struct...) have no fixed set of columns
+            columns.append(pa.field(name, pa.string()))
+            plan[field.number] = FieldPlan(name, _json_converter(field))
+        elif message_type is not None:
+            if message_type.full_name == "google.protobuf.Timestamp":
+                columns.append(pa.field(name, pa.timestamp("us", tz="UTC")))
+                plan[field.number] = FieldPlan(name, _to_micros)
+            elif message_type.full_name == "google.protobuf.Duration":
+                columns.append(pa.field(name, pa.duration("us")))
+                plan[field.number] = FieldPlan(name, _to_micros)
+            else:
+                children = _compile(
+                    message_type.fields,
+                    name + "_",
+                    path | {message_type.full_name},
+                    columns,
+                )
+                if children:
+                    plan[field.number] = FieldPlan(children=children)
+        elif field.type == FieldDescriptor.TYPE_ENUM:
+            columns.append(pa.field(name, pa.string()))
+            plan[field.number] = FieldPlan(name, _enum_converter(field))
+        else:
+            columns.append(pa.field(name, _SCALAR_TYPES[field.type]))
+            plan[field.number] = FieldPlan(name, _identity)
+    return plan
+
+
+@dataclass
+class EventPlan:
+    """Columns and flattening plan for one event type."""
+
+    schema: pa.Schema
+    plan: Dict[int, FieldPlan]
+
+
+_ROOT_PATH = frozenset([HistoryEvent.DESCRIPTOR.full_name])
+
+
+@lru_cache(maxsize=None)
+def _common_plan() -> EventPlan:
+    # Columns shared by every event type, i.e. everything but the attributes
+    columns = [pa.field("WorkflowId", pa.string()), pa.field("RunId", pa.string())]
+    plan = _compile(
+        [f for f in HistoryEvent.DESCRIPTOR.fields if f.containing_oneof is None],
+        "",
+        _ROOT_PATH,
+        columns,
+    )
+    return EventPlan(pa.schema(columns), plan)
+
+
+@lru_cache(maxsize=None)
+def event_type_name(event_type: int) -> str:
+    """Name of an event type without its ``EVENT_TYPE_`` prefix."""
+    try:
+        return EventType.Name(event_type)[len(_EVENT_TYPE_PREFIX) :]  # type: ignore
+    except ValueError:
+        # Event type added to a newer server than these protos know about
+        return f"UNKNOWN_{event_type}"
+
+
+def _project(
+    plan: Dict[int, FieldPlan], columns: FrozenSet[str]
+) -> Dict[int, FieldPlan]:
+    # Drops the fields, and whole nested messages, that fill no wanted column
+    projected: Dict[int, FieldPlan] = {}
+    for number, field_plan in plan.items():
+        if field_plan.children is not None:
+            children = _project(field_plan.children, columns)
+            if children:
+                projected[number] = FieldPlan(children=children)
+        elif field_plan.column in columns:
+            projected[number] = field_plan
+    return projected
+
+
+@lru_cache(maxsize=None)
+def event_plan(event_type: str, columns: Optional[FrozenSet[str]] = None) -> EventPlan:
+    """Stable columns and flattening plan of an event type.
+
+    If columns are given, only those columns are kept, along with WorkflowId
+    and RunId, and the fields filling no other column are never visited.
+    """
+    if columns is not None:
+        full = event_plan(event_type)
+        keep = columns | {"WorkflowId", "RunId"}
+        return EventPlan(
+            pa.schema([field for field in full.schema if field.name in keep]),
+            _project(full.plan, keep),
+        )
+    common = _common_plan()
+    fields = list(common.schema)
+    plan = dict(common.plan)
+    attributes = HistoryEvent.DESCRIPTOR.fields_by_name.get(
+        f"{event_type.lower()}_event_attributes"
+    )
+    if attributes is not None:
+        plan.update(_compile([attributes], "", _ROOT_PATH, fields))
+    return EventPlan(pa.schema(fields), plan)
+
+
+def event_types() -> List[str]:
+    """All event types known to the installed Temporal API protos."""
+    return [
+        event_type_name(value)
+        for value in EventType.values()
+        if value != EventType.EVENT_TYPE_UNSPECIFIED
+    ]
+
+
+def validate_projection(
+    allowed_event_types: Optional[Iterable[str]], columns: Optional[Iterable[str]]
+) -> None:
+    """Raise ValueError for event types or columns no event type has."""
+    known_event_types = event_types()
+    unknown = set(allowed_event_types or ()) - set(known_event_types)
+    if unknown:
+        raise ValueError(f"Unknown event types: {sorted(unknown)}")
+    known_columns = {
+        field.name
+        for event_type in allowed_event_types or known_event_types
+        for field in event_plan(event_type).schema
+    }
+    unknown = set(columns or ()) - known_columns
+    if unknown:
+        raise ValueError(f"Unknown columns: {sorted(unknown)}")
+
+
+@lru_cache(maxsize=None)
+def schema_registry() -> Dict[str, Any]:
+    """JSON document describing the columns of every event type.
+
+    Written next to the parquet output so downstream engines can declare
+    tables up front instead of inferring and unioning file schemas.
+    """
+    schemas = {
+        event_type: [
+            {"name": field.name, "type": str(field.type)}
+            for field in event_plan(event_type).schema
+        ]
+        for event_type in event_types()
+    }
+    fingerprint = hashlib.sha256(
+        json.dumps(schemas, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+    return {
+        "version": f"{SCHEMA_RULES_VERSION}-{fingerprint[:12]}",
+        "event_types": schemas,
+    }
+
+
+def schema_version() -> str:
+    return schema_registry()["version"]
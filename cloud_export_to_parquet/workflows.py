@@ -1,25 +1,67 @@
-from datetime import timedelta
+import asyncio
+import dataclasses
+import itertools
+from datetime import datetime, timedelta
+from typing import List, Optional
 
 from temporalio import workflow
 from temporalio.common import RetryPolicy
-from temporalio.exceptions import ActivityError
+from temporalio.exceptions import ActivityError, ApplicationError
 
 with workflow.unsafe.imports_passed_through():
     from cloud_export_to_parquet.data_trans_activities import (
+        CompactPartitionActivityInput,
+        DataTransActivities,
         DataTransAndLandActivityInput,
-        data_trans_and_land,
-        get_object_keys,
+        DataTransAndLandResult,
         GetObjectKeysActivityInput,
+        GetPartitionsActivityInput,
+        RegisterSchemaActivityInput,
     )
 from dataclasses import dataclass
 
 
+@dataclass
+class ProtoToParquetSummary:
+    # Export files converted, and skipped since an earlier run landed them
+    converted_files: int = 0
+    skipped_files: int = 0
+    # Parquet files landed by the converted export files
+    landed_files: int = 0
+    failed_keys: List[str] = dataclasses.field(default_factory=list)
+
+
+@dataclass
+class ProtoToParquetWorkflowResult:
+    write_path: str
+    summary: ProtoToParquetSummary
+
+
 @dataclass
 class ProtoToParquetWorkflowInput:
     num_delay_hour: int
     export_s3_bucket: str
     namespace: str
     output_s3_bucket: str
+    # Maximum number of export files converted concurrently
+    max_parallel_files: int = 10
+    # Task queue of a dedicated conversion worker, defaults to this workflow's
+    conversion_task_queue: Optional[str] = None
+    # Number of object keys handled per run before continuing as new
+    page_size: int = 1000
+    # Only export these event types (e.g. ACTIVITY_TASK_FAILED) and columns
+    # (e.g. activityTaskFailedEventAttributes_failure_message), all of them if
+    # unset. WorkflowId and RunId are always exported.
+    event_types: Optional[List[str]] = None
+    columns: Optional[List[str]] = None
+    # Merge the hour's small files once every export file has landed
+    compact_after_landing: bool = False
+    # Set when continuing as new to resume the same hour from the last page
+    read_time: Optional[str] = None
+    start_after: Optional[str] = None
+    summary: ProtoToParquetSummary = dataclasses.field(
+        default_factory=ProtoToParquetSummary
+    )
 
 
 @workflow.defn
@@ -27,48 +69,182 @@ class ProtoToParquet:
     """Proto to parquet workflow."""
 
     @workflow.run
-    async def run(self, workflow_input: ProtoToParquetWorkflowInput) -> str:
+    async def run(
+        self, workflow_input: ProtoToParquetWorkflowInput
+    ) -> ProtoToParquetWorkflowResult:
         """Run proto to parquet workflow."""
         retry_policy = RetryPolicy(
             maximum_attempts=10, maximum_interval=timedelta(seconds=5)
         )
 
-        # Read from export S3 bucket and given at least 2 hour delay to ensure the file has been uploaded
-        read_time = workflow.now() - timedelta(hours=workflow_input.num_delay_hour)
+        if workflow_input.read_time:
+            read_time = datetime.fromisoformat(workflow_input.read_time)
+        else:
+            # Read from export S3 bucket and given at least 2 hour delay to ensure the file has been uploaded
+            read_time = workflow.now() - timedelta(hours=workflow_input.num_delay_hour)
         common_path = f"{workflow_input.namespace}/{read_time.year}/{read_time.month:02}/{read_time.day:02}/{read_time.hour:02}/00"
         path = f"temporal-workflow-history/export/{common_path}"
         get_object_keys_input = GetObjectKeysActivityInput(
-            workflow_input.export_s3_bucket, path
+            workflow_input.export_s3_bucket,
+            path,
+            workflow_input.start_after,
+            workflow_input.page_size,
         )
 
-        # Read Input File
-        object_keys_output = await workflow.execute_activity(
-            get_object_keys,
+        # Read a page of input files
+        object_keys_page = await workflow.execute_activity_method(
+            DataTransActivities.get_object_keys,
             get_object_keys_input,
             start_to_close_timeout=timedelta(minutes=5),
             retry_policy=retry_policy,
         )
 
-        write_path = f"temporal-workflow-history/parquet/{common_path}"
+        # Hive-style partitions let query engines prune by namespace and time.
+        # Each file lands under a further event_type= partition.
+        output_path = "temporal-workflow-history/parquet"
+        write_path = f"{output_path}/namespace={workflow_input.namespace}/date={read_time.year}-{read_time.month:02}-{read_time.day:02}/hour={read_time.hour:02}"
 
-        try:
-            # Could create a list of corountine objects to process files in parallel
-            for key in object_keys_output:
-                data_trans_and_land_input = DataTransAndLandActivityInput(
-                    workflow_input.export_s3_bucket,
-                    key,
-                    workflow_input.output_s3_bucket,
-                    write_path,
-                )
-                # Convert proto to parquet and save to S3
-                await workflow.execute_activity(
-                    data_trans_and_land,
-                    data_trans_and_land_input,
+        # Persist the schema of each event type once per run of the schedule
+        if not workflow_input.start_after:
+            await workflow.execute_activity_method(
+                DataTransActivities.register_schema,
+                RegisterSchemaActivityInput(
+                    workflow_input.output_s3_bucket, output_path
+                ),
+                start_to_close_timeout=timedelta(minutes=1),
+                retry_policy=retry_policy,
+            )
+
+        # Convert proto to parquet and save to S3, keeping at most
+        # max_parallel_files activities in flight at a time
+        semaphore = asyncio.Semaphore(workflow_input.max_parallel_files)
+
+        async def trans_and_land(
+            key: str, etag: Optional[str]
+        ) -> DataTransAndLandResult:
+            async with semaphore:
+                return await workflow.execute_activity_method(
+                    DataTransActivities.data_trans_and_land,
+                    DataTransAndLandActivityInput(
+                        workflow_input.export_s3_bucket,
+                        key,
+                        workflow_input.output_s3_bucket,
+                        write_path,
+                        event_types=workflow_input.event_types,
+                        columns=workflow_input.columns,
+                        object_etag=etag,
+                    ),
+                    task_queue=workflow_input.conversion_task_queue,
                     start_to_close_timeout=timedelta(minutes=15),
+                    # Progress is heartbeated so retries resume where the
+                    # previous attempt left off
+                    heartbeat_timeout=timedelta(minutes=2),
+                    retry_policy=retry_policy,
+                )
+
+        # Let every file finish (or exhaust its retries) before reporting, so
+        # one bad file does not abandon the rest of the hour
+        results = await asyncio.gather(
+            *[
+                trans_and_land(key, etag)
+                for key, etag in itertools.zip_longest(
+                    object_keys_page.keys, object_keys_page.etags
+                )
+            ],
+            return_exceptions=True,
+        )
+        # Only counts are kept per key, so continuing as new doesn't carry
+        # every key of the hour
+        summary = dataclasses.replace(
+            workflow_input.summary,
+            failed_keys=list(workflow_input.summary.failed_keys),
+        )
+        for key, result in zip(object_keys_page.keys, results):
+            if isinstance(result, ActivityError):
+                workflow.logger.error(f"Data transformation failed for {key}: {result}")
+                summary.failed_keys.append(key)
+            elif isinstance(result, BaseException):
+                raise result
+            elif result.already_landed:
+                summary.skipped_files += 1
+            else:
+                summary.converted_files += 1
+                summary.landed_files += result.landed_files
+        workflow_result = ProtoToParquetWorkflowResult(write_path, summary)
+
+        # Continue as new for the next page so history stays bounded however
+        # many objects were exported this hour
+        if object_keys_page.next_start_after:
+            workflow.continue_as_new(
+                dataclasses.replace(
+                    workflow_input,
+                    read_time=read_time.isoformat(),
+                    start_after=object_keys_page.next_start_after,
+                    summary=summary,
+                )
+            )
+
+        if summary.failed_keys:
+            raise ApplicationError(
+                f"Data transformation failed for {len(summary.failed_keys)} files",
+                workflow_result,
+            )
+
+        if workflow_input.compact_after_landing:
+            await workflow.execute_child_workflow(
+                CompactParquet.run,
+                CompactParquetWorkflowInput(
+                    workflow_input.output_s3_bucket, write_path
+                ),
+                id=f"{workflow.info().workflow_id}-compact",
+            )
+
+        return workflow_result
+
+
+@dataclass
+class CompactParquetWorkflowInput:
+    bucket: str
+    path: str
+    # Files smaller than this are merged into files of about this size
+    target_file_bytes: int = 128 * 1024 * 1024
+    # Maximum number of partitions compacted concurrently
+    max_parallel_partitions: int = 10
+
+
+@workflow.defn
+class CompactParquet:
+    """Merge small parquet files workflow."""
+
+    @workflow.run
+    async def run(self, workflow_input: CompactParquetWorkflowInput) -> List[str]:
+        """Run merge small parquet files workflow."""
+        retry_policy = RetryPolicy(
+            maximum_attempts=10, maximum_interval=timedelta(seconds=5)
+        )
+
+        partitions = await workflow.execute_activity_method(
+            DataTransActivities.get_partitions,
+            GetPartitionsActivityInput(workflow_input.bucket, workflow_input.path),
+            start_to_close_timeout=timedelta(minutes=5),
+            retry_policy=retry_policy,
+        )
+
+        semaphore = asyncio.Semaphore(workflow_input.max_parallel_partitions)
+
+        async def compact(partition: str) -> str:
+            async with semaphore:
+                return await workflow.execute_activity_method(
+                    DataTransActivities.compact_partition,
+                    CompactPartitionActivityInput(
+                        workflow_input.bucket,
+                        partition,
+                        workflow_input.target_file_bytes,
+                    ),
+                    start_to_close_timeout=timedelta(minutes=30),
+                    heartbeat_timeout=timedelta(minutes=2),
                     retry_policy=retry_policy,
                 )
-        except ActivityError as output_err:
-            workflow.logger.error(f"Data transformation failed: {output_err}")
-            raise output_err
 
-        return write_path
+        # Returns the manifest of each partition
+        return list(await asyncio.gather(*[compact(p) for p in partitions]))
@@ -4,15 +4,29 @@ import asyncio
 import dataclasses
 from dataclasses import dataclass
 from datetime import timedelta
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Awaitable, Dict, List, Literal, Optional, Union
 
 from temporalio import workflow
+from temporalio.common import RetryPolicy
+from temporalio.exceptions import ApplicationError
+
+# What a fan-out does when one of its branches fails. fail_fast cancels the
+# others and raises the failure. wait_all lets the others finish, then raises
+# the first failure. best_effort lets the others finish and ignores failures,
+# leaving None as the failed branches' results.
+FailurePolicy = Literal["fail_fast", "wait_all", "best_effort"]
 
 
 @dataclass
 class DSLInput:
     root: Statement
     variables: Dict[str, Any] = dataclasses.field(default_factory=dict)
+    # Continue as new once the history has this many events, in addition to
+    # when the server suggests it
+    max_history_length: Optional[int] = None
+    # Where a continued workflow resumes: the index of the sequence element
+    # to start at in each sequence on the path from the root
+    program_counter: List[int] = dataclasses.field(default_factory=list)
 
 
 @dataclass
@@ -25,6 +39,37 @@ class ActivityInvocation:
     name: str
     arguments: List[str] = dataclasses.field(default_factory=list)
     result: Optional[str] = None
+    # Run as a local activity, in the workflow's worker without a round trip
+    # through a task queue. Only for short activities, since the workflow task
+    # waits for it.
+    local: bool = False
+    # Task queue of the activity, or the workflow's if not set. Not for local
+    # activities.
+    task_queue: Optional[str] = None
+    # Timeouts in seconds. Local activities can't heartbeat.
+    start_to_close_timeout: float = 60
+    schedule_to_close_timeout: Optional[float] = None
+    heartbeat_timeout: Optional[float] = None
+    retry_policy: Optional[ActivityRetryPolicy] = None
+
+
+@dataclass
+class ActivityRetryPolicy:
+    # Intervals in seconds. Zero maximum attempts means no limit.
+    initial_interval: float = 1
+    backoff_coefficient: float = 2
+    maximum_interval: Optional[float] = None
+    maximum_attempts: int = 0
+    non_retryable_error_types: Optional[List[str]] = None
+
+    def to_retry_policy(self) -> RetryPolicy:
+        return RetryPolicy(
+            initial_interval=timedelta(seconds=self.initial_interval),
+            backoff_coefficient=self.backoff_coefficient,
+            maximum_interval=_seconds(self.maximum_interval),
+            maximum_attempts=self.maximum_attempts,
+            non_retryable_error_types=self.non_retryable_error_types,
+        )
 
 
 @dataclass
@@ -45,41 +90,363 @@ class ParallelStatement:
 @dataclass
 class Parallel:
     branches: List[Statement]
+    failure_policy: FailurePolicy = "fail_fast"
+
+
+@dataclass
+class DagStatement:
+    dag: Dag
+
+
+@dataclass
+class Dag:
+    nodes: List[DagNode]
+    failure_policy: FailurePolicy = "fail_fast"
+
+
+@dataclass
+class DagNode:
+    activity: ActivityInvocation
+    # Result variables of other nodes to wait for, in addition to the ones
+    # used as arguments
+    depends_on: List[str] = dataclasses.field(default_factory=list)
 
 
-Statement = Union[ActivityStatement, SequenceStatement, ParallelStatement]
+@dataclass
+class ForEachStatement:
+    foreach: ForEach
+
+
+@dataclass
+class ForEach:
+    # List variable to run the activity over
+    items: str
+    # Name the activity's arguments use for the current item
+    item: str
+    # Its result is the list of per-item results, in the order of the items
+    activity: ActivityInvocation
+    max_concurrency: int = 10
+    # Run the items in child workflows of at most this many items each, to
+    # keep this workflow's history small
+    chunk_size: Optional[int] = None
+    failure_policy: FailurePolicy = "fail_fast"
+
+
+@dataclass
+class ChildWorkflowStatement:
+    child_workflow: ChildWorkflow
+
+
+@dataclass
+class ChildWorkflow:
+    # Runs in its own workflow, so its events are not in this history
+    root: Statement
+    # Variables to pass to the child, or all of them if not set
+    inputs: Optional[List[str]] = None
+    # Variables to copy back from the child, or all of them if not set
+    outputs: Optional[List[str]] = None
+
+
+Statement = Union[
+    ActivityStatement,
+    SequenceStatement,
+    ParallelStatement,
+    DagStatement,
+    ForEachStatement,
+    ChildWorkflowStatement,
+]
 
 
 @workflow.defn
 class DSLWorkflow:
     @workflow.run
     async def run(self, input: DSLInput) -> Dict[str, Any]:
+        self.input = input
         self.variables = dict(input.variables)
+        self.resume_at = list(input.program_counter)
+        self.child_workflows = 0
         workflow.logger.info("Running DSL workflow")
-        await self.execute_statement(input.root)
+        await self.execute_statement(input.root, [])
         workflow.logger.info("DSL workflow completed")
         return self.variables
 
-    async def execute_statement(self, stmt: Statement) -> None:
+    async def execute_statement(
+        self, stmt: Statement, path: Optional[List[int]] = None
+    ) -> None:
+        # The path is the statement's program counter, or None within fan-outs,
+        # where the workflow can't continue as new between statements
         if isinstance(stmt, ActivityStatement):
             # Invoke activity loading arguments from variables and optionally
             # storing result as a variable
-            result = await workflow.execute_activity(
-                stmt.activity.name,
-                args=[self.variables.get(arg, "") for arg in stmt.activity.arguments],
-                start_to_close_timeout=timedelta(minutes=1),
-            )
+            result = await self.execute_activity(stmt.activity, self.variables)
             if stmt.activity.result:
                 self.variables[stmt.activity.result] = result
         elif isinstance(stmt, SequenceStatement):
-            # Execute each statement in order
-            for elem in stmt.sequence.elements:
-                await self.execute_statement(elem)
+            # Execute each statement in order, continuing as new between them
+            # when the history gets long
+            start = 0
+            resumed = path is not None and bool(self.resume_at)
+            if resumed:
+                start = self.resume_at.pop(0)
+            for index in range(start, len(stmt.sequence.elements)):
+                elem_path = None if path is None else path + [index]
+                # The element a continued run resumes at runs before checking
+                # again, so every run makes progress however short
+                # max_history_length is
+                if (
+                    elem_path is not None
+                    and not self.resume_at
+                    and not (resumed and index == start)
+                ):
+                    self.continue_as_new_if_needed(elem_path)
+                await self.execute_statement(stmt.sequence.elements[index], elem_path)
         elif isinstance(stmt, ParallelStatement):
-            # Execute all in parallel. Note, this will raise an exception when
-            # the first activity fails and will not cancel the others. We could
-            # store tasks and cancel if we wanted. In newer Python versions this
-            # would use a TaskGroup instead.
-            await asyncio.gather(
-                *[self.execute_statement(branch) for branch in stmt.parallel.branches]
+            # Execute all in parallel, handling failures per the policy
+            await self.gather(
+                [self.execute_statement(branch) for branch in stmt.parallel.branches],
+                stmt.parallel.failure_policy,
             )
+        elif isinstance(stmt, DagStatement):
+            await self.execute_dag(stmt.dag)
+        elif isinstance(stmt, ForEachStatement):
+            await self.execute_foreach(stmt.foreach)
+        elif isinstance(stmt, ChildWorkflowStatement):
+            await self.execute_child_workflow(stmt.child_workflow)
+
+    def continue_as_new_if_needed(self, program_counter: List[int]) -> None:
+        # Replaying a long history is slow and histories have a size limit, so
+        # continue with a new one, passing the variables and where to resume
+        info = workflow.info()
+        max_length = self.input.max_history_length
+        if info.is_continue_as_new_suggested() or (
+            max_length is not None and info.get_current_history_length() >= max_length
+        ):
+            workflow.logger.info(f"Continuing as new at {program_counter}")
+            workflow.continue_as_new(
+                dataclasses.replace(
+                    self.input,
+                    variables=self.variables,
+                    program_counter=program_counter,
+                )
+            )
+
+    async def execute_child_workflow(self, child: ChildWorkflow) -> None:
+        # Run the statement in a child workflow with its own history, copying
+        # only the variables it needs in and the ones it produces out
+        if child.inputs is None:
+            variables = dict(self.variables)
+        else:
+            variables = {name: self.variables.get(name, "") for name in child.inputs}
+        self.child_workflows += 1
+        info = workflow.info()
+        child_variables = await workflow.execute_child_workflow(
+            DSLWorkflow.run,
+            DSLInput(
+                root=child.root,
+                variables=variables,
+                max_history_length=self.input.max_history_length,
+            ),
+            id=f"{info.workflow_id}-{info.run_id}-child-{self.child_workflows}",
+        )
+        for name in child_variables if child.outputs is None else child.outputs:
+            if name in child_variables:
+                self.variables[name] = child_variables[name]
+
+    async def execute_activity(
+        self, activity: ActivityInvocation, variables: Dict[str, Any]
+    ) -> Any:
+        args = [variables.get(arg, "") for arg in activity.arguments]
+        retry_policy = None
+        if activity.retry_policy:
+            retry_policy = activity.retry_policy.to_retry_policy()
+        if activity.local:
+            if activity.task_queue or activity.heartbeat_timeout is not None:
+                raise ApplicationError(
+                    f"Local activity {activity.name} can't have a task queue or "
+                    "heartbeat timeout",
+                    non_retryable=True,
+                )
+            return await workflow.execute_local_activity(
+                activity.name,
+                args=args,
+                start_to_close_timeout=timedelta(
+                    seconds=activity.start_to_close_timeout
+                ),
+                schedule_to_close_timeout=_seconds(activity.schedule_to_close_timeout),
+                retry_policy=retry_policy,
+            )
+        return await workflow.execute_activity(
+            activity.name,
+            args=args,
+            task_queue=activity.task_queue,
+            start_to_close_timeout=timedelta(seconds=activity.start_to_close_timeout),
+            schedule_to_close_timeout=_seconds(activity.schedule_to_close_timeout),
+            heartbeat_timeout=_seconds(activity.heartbeat_timeout),
+            retry_policy=retry_policy,
+        )
+
+    async def gather(
+        self, aws: List[Awaitable[Any]], failure_policy: FailurePolicy
+    ) -> List[Any]:
+        # Like asyncio.gather, but on failure applies the policy. Cancelling a
+        # task running an activity requests cancellation of the activity, so
+        # failed runs release worker slots rather than wait for siblings whose
+        # results would be discarded.
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        if failure_policy == "fail_fast":
+            try:
+                return list(await asyncio.gather(*tasks))
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                # Wait for the cancellations, so nothing outlives the statement
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors and failure_policy == "wait_all":
+            raise errors[0]
+        for error in errors:
+            workflow.logger.warning(f"Ignoring failed branch: {error}")
+        return [None if isinstance(r, BaseException) else r for r in results]
+
+    async def execute_dag(self, dag: Dag) -> None:
+        # A node depends on the nodes producing its arguments and the results
+        # it depends on. Each node starts as soon as those nodes complete, so
+        # the DAG takes as long as its critical path.
+        producers: Dict[str, int] = {}
+        for index, node in enumerate(dag.nodes):
+            if node.activity.result in producers:
+                raise ApplicationError(
+                    f"More than one node of the DAG produces {node.activity.result}",
+                    non_retryable=True,
+                )
+            if node.activity.result:
+                producers[node.activity.result] = index
+        dependencies = []
+        for node in dag.nodes:
+            for name in node.depends_on:
+                if name not in producers:
+                    raise ApplicationError(
+                        f"Activity {node.activity.name} depends on {name}, "
+                        "which no node of the DAG produces",
+                        non_retryable=True,
+                    )
+            dependencies.append(
+                {
+                    producers[name]
+                    for name in node.activity.arguments + node.depends_on
+                    if name in producers
+                }
+            )
+
+        # Start nodes in topological order, so the tasks a node waits for
+        # already exist
+        tasks: Dict[int, asyncio.Task] = {}
+
+        async def run_node(index: int) -> None:
+            await asyncio.gather(*[tasks[d] for d in dependencies[index]])
+            await self.execute_statement(ActivityStatement(dag.nodes[index].activity))
+
+        while len(tasks) < len(dag.nodes):
+            ready = [
+                index
+                for index in range(len(dag.nodes))
+                if index not in tasks and dependencies[index].issubset(tasks)
+            ]
+            if not ready:
+                raise ApplicationError(
+                    "DAG has a dependency cycle between activities "
+                    + ", ".join(
+                        dag.nodes[index].activity.name
+                        for index in range(len(dag.nodes))
+                        if index not in tasks
+                    ),
+                    non_retryable=True,
+                )
+            for index in ready:
+                tasks[index] = asyncio.create_task(run_node(index))
+        # Nodes depending on a failed node fail with the same error
+        await self.gather(list(tasks.values()), dag.failure_policy)
+
+    async def execute_foreach(self, foreach: ForEach) -> None:
+        items = self.variables.get(foreach.items, [])
+        if not isinstance(items, list):
+            raise ApplicationError(
+                f"foreach expects {foreach.items} to be a list", non_retryable=True
+            )
+        if foreach.max_concurrency < 1:
+            raise ApplicationError(
+                "foreach max_concurrency must be at least 1", non_retryable=True
+            )
+        if foreach.chunk_size is not None and foreach.chunk_size < 1:
+            raise ApplicationError(
+                "foreach chunk_size must be at least 1", non_retryable=True
+            )
+        if foreach.chunk_size:
+            results = await self.execute_foreach_chunks(foreach, items)
+        else:
+            # Every item gets a coroutine, but only max_concurrency of them
+            # schedule activities at a time
+            semaphore = asyncio.Semaphore(foreach.max_concurrency)
+
+            async def run_item(item: Any) -> Any:
+                async with semaphore:
+                    return await self.execute_activity(
+                        foreach.activity, {**self.variables, foreach.item: item}
+                    )
+
+            results = await self.gather(
+                [run_item(item) for item in items], foreach.failure_policy
+            )
+        if foreach.activity.result:
+            self.variables[foreach.activity.result] = results
+
+    async def execute_foreach_chunks(
+        self, foreach: ForEach, items: List[Any]
+    ) -> List[Any]:
+        # Each chunk runs in a child workflow with only the variables its
+        # activity needs. Chunks run one at a time, so max_concurrency still
+        # bounds the activities running at once.
+        chunk_size = foreach.chunk_size or len(items)
+        variables = {
+            arg: self.variables.get(arg, "")
+            for arg in foreach.activity.arguments
+            if arg != foreach.item
+        }
+        chunk_foreach = dataclasses.replace(foreach, chunk_size=None)
+        results: List[Any] = []
+        errors: List[Exception] = []
+        info = workflow.info()
+        for index, start in enumerate(range(0, len(items), chunk_size)):
+            chunk = items[start : start + chunk_size]
+            # Unique per run, as foreach statements can run concurrently
+            self.child_workflows += 1
+            try:
+                chunk_variables = await workflow.execute_child_workflow(
+                    DSLWorkflow.run,
+                    DSLInput(
+                        root=ForEachStatement(chunk_foreach),
+                        variables={**variables, foreach.items: chunk},
+                    ),
+                    id=f"{info.workflow_id}-{info.run_id}-chunk-{self.child_workflows}",
+                )
+            except Exception as err:
+                # The child applied the policy to its own items
+                if foreach.failure_policy == "fail_fast":
+                    raise
+                if foreach.failure_policy == "wait_all":
+                    errors.append(err)
+                else:
+                    workflow.logger.warning(f"Ignoring failed chunk {index}: {err}")
+                results.extend([None] * len(chunk))
+                continue
+            if foreach.activity.result:
+                results.extend(chunk_variables[foreach.activity.result])
+        if errors:
+            raise errors[0]
+        return results
+
+
+def _seconds(seconds: Optional[float]) -> Optional[timedelta]:
+    return None if seconds is None else timedelta(seconds=seconds)
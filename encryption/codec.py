@@ -1,57 +1,162 @@
+import asyncio
 import os
-from typing import Iterable, List
+from concurrent.futures import Executor
+from functools import partial
+from typing import Callable, Iterable, List, Optional, Tuple
 
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from temporalio.api.common.v1 import Payload
 from temporalio.converter import PayloadCodec
 
+from encryption.key_ring import KeyRing
+
 default_key = b"test-key-test-key-test-key-test!"
 default_key_id = "test-key-id"
 
+# A function to apply to some payload data, and the data
+Job = Tuple[Callable[[bytes], bytes], bytes]
+
 
-class EncryptionCodec(PayloadCodec):
-    def __init__(self, key_id: str = default_key_id, key: bytes = default_key) -> None:
+class OffloadingCodec(PayloadCodec):
+    """Base for codecs that transform payload data off the event loop."""
+
+    def __init__(
+        self,
+        *,
+        offload_threshold: Optional[int] = 64 * 1024,
+        offload_batch_bytes: int = 1024 * 1024,
+        executor: Optional[Executor] = None,
+    ) -> None:
         super().__init__()
-        self.key_id = key_id
+        # Payloads at least this large are encrypted off the event loop, so a
+        # task with large payloads doesn't stall every other workflow on the
+        # worker. AESGCM releases the GIL, so batches run in parallel in the
+        # executor (the loop's default executor if not set). Smaller payloads
+        # are cheaper to encrypt inline than to hand off. None disables it.
+        self.offload_threshold = offload_threshold
+        # Large payloads are handed off in batches of about this many bytes
+        self.offload_batch_bytes = offload_batch_bytes
+        self.executor = executor
+
+    async def _apply(self, jobs: List[Job]) -> List[bytes]:
+        # Applies each job's function to its data, small ones inline and large
+        # ones in batches on the executor, keeping the order of the jobs
+        results = [data for _, data in jobs]
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_bytes = 0
+        for index, (fn, data) in enumerate(jobs):
+            if self.offload_threshold is None or len(data) < self.offload_threshold:
+                results[index] = fn(data)
+                continue
+            batch.append(index)
+            batch_bytes += len(data)
+            if batch_bytes >= self.offload_batch_bytes:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            batches.append(batch)
+        if batches:
+            loop = asyncio.get_running_loop()
+            done = await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        self.executor, _apply_batch, [jobs[i] for i in batch]
+                    )
+                    for batch in batches
+                ]
+            )
+            for batch, batch_results in zip(batches, done):
+                for index, result in zip(batch, batch_results):
+                    results[index] = result
+        return results
+
+
+class EncryptionCodec(OffloadingCodec):
+    def __init__(
+        self,
+        key_id: str = default_key_id,
+        key: bytes = default_key,
+        *,
+        key_ring: Optional[KeyRing] = None,
+        offload_threshold: Optional[int] = 64 * 1024,
+        offload_batch_bytes: int = 1024 * 1024,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        super().__init__(
+            offload_threshold=offload_threshold,
+            offload_batch_bytes=offload_batch_bytes,
+            executor=executor,
+        )
         # We are using direct AESGCM to be compatible with samples from
         # TypeScript and Go. Pure Python samples may prefer the higher-level,
-        # safer APIs.
-        self.encryptor = AESGCM(key)
+        # safer APIs. Payloads are encrypted with the key ring's current key
+        # and decrypted with the key their metadata names, so keys can be
+        # rotated without an outage.
+        self.key_ring = key_ring or KeyRing({key_id: key}, key_id)
+
+    @property
+    def key_id(self) -> str:
+        return self.key_ring.current_key_id
 
     async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
-        # We blindly encode all payloads with the key and set the metadata
-        # saying which key we used
+        # We blindly encode all payloads with the current key and set the
+        # metadata saying which key we used
+        key_id = self.key_ring.current_key_id
+        ciphers = await self.key_ring.resolve([key_id])
+        encrypt = partial(encrypt_with, ciphers[key_id])
+        encrypted = await self._apply(
+            [(encrypt, p.SerializeToString()) for p in payloads]
+        )
         return [
             Payload(
                 metadata={
                     "encoding": b"binary/encrypted",
-                    "encryption-key-id": self.key_id.encode(),
+                    "encryption-key-id": key_id.encode(),
                 },
-                data=self.encrypt(p.SerializeToString()),
+                data=data,
             )
-            for p in payloads
+            for data in encrypted
         ]
 
     async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
-        ret: List[Payload] = []
-        for p in payloads:
+        ret = list(payloads)
+        # Indexes in ret of the payloads to decrypt, and their key IDs
+        indexes: List[int] = []
+        key_ids: List[str] = []
+        for index, p in enumerate(ret):
             # Ignore ones w/out our expected encoding
             if p.metadata.get("encoding", b"").decode() != "binary/encrypted":
-                ret.append(p)
                 continue
-            # Confirm our key ID is the same
-            key_id = p.metadata.get("encryption-key-id", b"").decode()
-            if key_id != self.key_id:
-                raise ValueError(
-                    f"Unrecognized key ID {key_id}. Current key ID is {self.key_id}."
-                )
-            # Decrypt and append
-            ret.append(Payload.FromString(self.decrypt(p.data)))
+            # Find the key it was encrypted with
+            indexes.append(index)
+            key_ids.append(p.metadata.get("encryption-key-id", b"").decode())
+        # Look up each key once, off the event loop if it isn't cached
+        ciphers = await self.key_ring.resolve(key_ids)
+        jobs: List[Job] = [
+            (partial(decrypt_with, ciphers[key_id]), ret[index].data)
+            for index, key_id in zip(indexes, key_ids)
+        ]
+        # Decrypt and replace
+        for index, data in zip(indexes, await self._apply(jobs)):
+            ret[index] = Payload.FromString(data)
         return ret
 
     def encrypt(self, data: bytes) -> bytes:
-        nonce = os.urandom(12)
-        return nonce + self.encryptor.encrypt(nonce, data, None)
+        return encrypt_with(self.key_ring.current()[1], data)
+
+    def decrypt(self, data: bytes, key_id: Optional[str] = None) -> bytes:
+        return decrypt_with(self.key_ring.get(key_id or self.key_id), data)
+
+
+def _apply_batch(jobs: List[Job]) -> List[bytes]:
+    return [fn(data) for fn, data in jobs]
+
+
+def encrypt_with(cipher: AESGCM, data: bytes) -> bytes:
+    nonce = os.urandom(12)
+    return nonce + cipher.encrypt(nonce, data, None)
+
 
-    def decrypt(self, data: bytes) -> bytes:
-        return self.encryptor.decrypt(data[:12], data[12:], None)
+def decrypt_with(cipher: AESGCM, data: bytes) -> bytes:
+    return cipher.decrypt(data[:12], data[12:], None)
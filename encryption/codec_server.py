@@ -1,52 +1,267 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
 from functools import partial
-from typing import Awaitable, Callable, Iterable, List
+from typing import Awaitable, Callable, List, Optional, Sequence, Tuple
 
 from aiohttp import hdrs, web
 from google.protobuf import json_format
+from google.protobuf.message import DecodeError
 from temporalio.api.common.v1 import Payload, Payloads
+from temporalio.converter import PayloadCodec
 
 from encryption.codec import EncryptionCodec
+from encryption.compression import CodecChain, CompressionCodec
+from encryption.decode_cache import CachingCodec
 
+JSON = "application/json"
+# Binary protobuf is much faster to parse and serialize than JSON, and doesn't
+# base64 encode payload data
+PROTOBUF = "application/x-protobuf"
 
-def build_codec_server() -> web.Application:
+PayloadsFn = Callable[[Sequence[Payload]], Awaitable[List[Payload]]]
+
+
+def _encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def parse_payloads_batch(content_type: str, body: bytes) -> List[Payloads]:
+    """Parse a batch of Payloads.
+
+    As JSON, a batch is an array of Payloads objects. As protobuf, it is a
+    stream of Payloads messages, each prefixed with its varint length.
+    """
+    if content_type == JSON:
+        items = json.loads(body)
+        if not isinstance(items, list):
+            raise ValueError("Batch must be an array")
+        return [json_format.ParseDict(item, Payloads()) for item in items]
+    batch = []
+    pos = 0
+    while pos < len(body):
+        length, pos = _decode_varint(body, pos)
+        if pos + length > len(body):
+            raise ValueError("Truncated Payloads")
+        batch.append(Payloads.FromString(body[pos : pos + length]))
+        pos += length
+    return batch
+
+
+def serialize_payloads_batch(content_type: str, batch: List[Payloads]) -> bytes:
+    """Serialize a batch of Payloads, see :py:func:`parse_payloads_batch`."""
+    if content_type == JSON:
+        return json.dumps([json_format.MessageToDict(p) for p in batch]).encode()
+    out = bytearray()
+    for payloads in batch:
+        data = payloads.SerializeToString()
+        out += _encode_varint(len(data))
+        out += data
+    return bytes(out)
+
+
+def _accepts_gzip(req: web.Request) -> bool:
+    # Whether Accept-Encoding lists gzip without a zero quality
+    for coding in req.headers.get(hdrs.ACCEPT_ENCODING, "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() == "gzip":
+            quality = params.strip().lower()
+            if not quality.startswith("q="):
+                return True
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def build_codec_server(
+    codec: Optional[PayloadCodec] = None, decode_cache_bytes: Optional[int] = None
+) -> web.Application:
     # Cors handler
     async def cors_options(req: web.Request) -> web.Response:
         resp = web.Response()
         if req.headers.get(hdrs.ORIGIN) == "http://localhost:8080":
             resp.headers[hdrs.ACCESS_CONTROL_ALLOW_ORIGIN] = "http://localhost:8080"
             resp.headers[hdrs.ACCESS_CONTROL_ALLOW_METHODS] = "POST"
-            resp.headers[hdrs.ACCESS_CONTROL_ALLOW_HEADERS] = "content-type,x-namespace"
+            resp.headers[
+                hdrs.ACCESS_CONTROL_ALLOW_HEADERS
+            ] = "content-type,accept,x-namespace"
+        return resp
+
+    def negotiate(req: web.Request) -> str:
+        # Respond in the request's content type unless another is accepted
+        if req.content_type not in (JSON, PROTOBUF):
+            raise web.HTTPUnsupportedMediaType(
+                text=f"Content type must be {JSON} or {PROTOBUF}"
+            )
+        accept = req.headers.get(hdrs.ACCEPT, "*/*")
+        if req.content_type in accept or "*/*" in accept:
+            return req.content_type
+        if PROTOBUF in accept:
+            return PROTOBUF
+        return JSON
+
+    async def respond(req: web.Request, content_type: str, body: bytes) -> web.Response:
+        # Apply CORS and gzip when the client accepts it. Gzip request bodies
+        # are decompressed by aiohttp.
+        resp = await cors_options(req)
+        resp.content_type = content_type
+        resp.body = body
+        if _accepts_gzip(req):
+            resp.enable_compression(web.ContentCoding.gzip)
         return resp
 
     # General purpose payloads-to-payloads
-    async def apply(
-        fn: Callable[[Iterable[Payload]], Awaitable[List[Payload]]], req: web.Request
-    ) -> web.Response:
-        # Read payloads as JSON
-        assert req.content_type == "application/json"
-        payloads = json_format.Parse(await req.read(), Payloads())
+    async def apply(fn: PayloadsFn, req: web.Request) -> web.Response:
+        response_type = negotiate(req)
+        body = await req.read()
+        try:
+            if req.content_type == JSON:
+                payloads = json_format.Parse(body, Payloads())
+            else:
+                payloads = Payloads.FromString(body)
+        except (DecodeError, json_format.ParseError, ValueError) as err:
+            raise web.HTTPBadRequest(text=f"Malformed Payloads: {err}")
 
         # Apply
         payloads = Payloads(payloads=await fn(payloads.payloads))
 
-        # Apply CORS and return JSON
-        resp = await cors_options(req)
-        resp.content_type = "application/json"
-        resp.text = json_format.MessageToJson(payloads)
-        return resp
+        if response_type == JSON:
+            return await respond(
+                req, JSON, json_format.MessageToJson(payloads).encode()
+            )
+        return await respond(req, PROTOBUF, payloads.SerializeToString())
+
+    # Many payloads-to-payloads in one round trip, e.g. a whole history
+    async def apply_batch(fn: PayloadsFn, req: web.Request) -> web.Response:
+        response_type = negotiate(req)
+        try:
+            batch = parse_payloads_batch(req.content_type, await req.read())
+        except (DecodeError, json_format.ParseError, ValueError) as err:
+            raise web.HTTPBadRequest(text=f"Malformed Payloads batch: {err}")
+
+        # Apply to every payload at once, so the codec can batch its work
+        results = await fn([p for payloads in batch for p in payloads.payloads])
+        out = []
+        start = 0
+        for payloads in batch:
+            end = start + len(payloads.payloads)
+            out.append(Payloads(payloads=results[start:end]))
+            start = end
+
+        return await respond(
+            req, response_type, serialize_payloads_batch(response_type, out)
+        )
+
+    # Build app. Large payloads are decrypted on the loop's default thread
+    # pool, see EncryptionCodec.
+    if codec is None:
+        codec = CodecChain([CompressionCodec(), EncryptionCodec()])
+    # Optionally serve repeated decodes of the same payloads from memory
+    cache: Optional[CachingCodec] = None
+    if decode_cache_bytes:
+        codec = cache = CachingCodec(codec, decode_cache_bytes)
+
+    async def cache_stats(req: web.Request) -> web.Response:
+        return web.json_response(cache.stats() if cache else {})
 
-    # Build app
-    codec = EncryptionCodec()
     app = web.Application()
     app.add_routes(
         [
             web.post("/encode", partial(apply, codec.encode)),
             web.post("/decode", partial(apply, codec.decode)),
             web.options("/decode", cors_options),
+            web.post("/encode/batch", partial(apply_batch, codec.encode)),
+            web.post("/decode/batch", partial(apply_batch, codec.decode)),
+            web.options("/decode/batch", cors_options),
+            web.get("/cache/stats", cache_stats),
         ]
     )
     return app
 
 
+def run_codec_server(
+    host: str,
+    port: int,
+    reuse_port: bool = False,
+    decode_cache_bytes: Optional[int] = None,
+) -> None:
+    web.run_app(
+        build_codec_server(decode_cache_bytes=decode_cache_bytes),
+        host=host,
+        port=port,
+        reuse_port=reuse_port,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run codec server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of server processes, e.g. the number of cores",
+    )
+    parser.add_argument(
+        "--decode-cache-bytes",
+        type=int,
+        help="Cache up to this many bytes of decoded payloads in each process",
+    )
+    args = parser.parse_args()
+
+    if args.workers == 1:
+        run_codec_server(args.host, args.port, False, args.decode_cache_bytes)
+        return
+    if not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers requires SO_REUSEPORT, which this platform lacks")
+    # Each process binds the port with SO_REUSEPORT and has its own event loop
+    # and codec, so they share nothing and the kernel balances connections
+    # between them
+    print(f"Starting {args.workers} codec server processes (pid {os.getpid()})")
+    processes = [
+        multiprocessing.Process(
+            target=run_codec_server,
+            args=(args.host, args.port, True, args.decode_cache_bytes),
+            daemon=True,
+        )
+        for _ in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
 if __name__ == "__main__":
-    web.run_app(build_codec_server(), host="127.0.0.1", port=8081)
+    main()
@@ -0,0 +1,161 @@
+import threading
+import zlib
+from concurrent.futures import Executor
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from temporalio.api.common.v1 import Payload
+from temporalio.converter import PayloadCodec
+
+from encryption.codec import Job, OffloadingCodec
+
+# zstd and lz4 are used when installed, with zlib as the fallback
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None  # type: ignore
+
+_Compressor = Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]
+
+# zstd compressors are not thread-safe, so each thread compressing payloads
+# (the event loop's and the executor's) gets its own
+_local = threading.local()
+
+
+def _new_compressors() -> Dict[str, _Compressor]:
+    compressors: Dict[str, _Compressor] = {
+        "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    }
+    if zstandard is not None:
+        compressors["zstd"] = (
+            zstandard.ZstdCompressor(level=3).compress,
+            # compress() records the content size, which decompress() needs
+            zstandard.ZstdDecompressor().decompress,
+        )
+    if lz4 is not None:
+        compressors["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    return compressors
+
+
+def _compressors() -> Dict[str, _Compressor]:
+    compressors = getattr(_local, "compressors", None)
+    if compressors is None:
+        compressors = _local.compressors = _new_compressors()
+    return compressors
+
+
+def _compress(algorithm: str, data: bytes) -> bytes:
+    return _compressors()[algorithm][0](data)
+
+
+def _decompress(algorithm: str, data: bytes) -> bytes:
+    return _compressors()[algorithm][1](data)
+
+
+class CompressionCodec(OffloadingCodec):
+    """Compresses payloads of at least ``min_size`` bytes.
+
+    Compressed payloads have the ``binary/compressed`` encoding and name their
+    algorithm in the ``compression`` metadata. Payloads that don't get smaller
+    are left as they are. Must run before encryption, since encrypted data
+    doesn't compress. Payloads of at least ``offload_threshold`` bytes are
+    compressed and decompressed on the executor, like ``EncryptionCodec``.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 1024,
+        large_size: int = 1024 * 1024,
+        *,
+        offload_threshold: Optional[int] = 64 * 1024,
+        offload_batch_bytes: int = 1024 * 1024,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        super().__init__(
+            offload_threshold=offload_threshold,
+            offload_batch_bytes=offload_batch_bytes,
+            executor=executor,
+        )
+        # Below this, headers and CPU cost more than compression saves
+        self.min_size = min_size
+        # At or above this, the fastest algorithm is used rather than the one
+        # with the best ratio, to bound the time spent per payload
+        self.large_size = large_size
+        self.algorithms = set(_compressors())
+
+    def algorithm(self, size: int) -> str:
+        """Algorithm for a payload of the given size."""
+        if size >= self.large_size and "lz4" in self.algorithms:
+            return "lz4"
+        if "zstd" in self.algorithms:
+            return "zstd"
+        return "zlib"
+
+    async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        ret = list(payloads)
+        indexes: List[int] = []
+        algorithms: List[str] = []
+        jobs: List[Job] = []
+        for index, p in enumerate(ret):
+            data = p.SerializeToString()
+            if len(data) < self.min_size:
+                continue
+            algorithm = self.algorithm(len(data))
+            indexes.append(index)
+            algorithms.append(algorithm)
+            jobs.append((partial(_compress, algorithm), data))
+        compressed = await self._apply(jobs)
+        for index, algorithm, (_, data), result in zip(
+            indexes, algorithms, jobs, compressed
+        ):
+            if len(result) >= len(data):
+                continue
+            ret[index] = Payload(
+                metadata={
+                    "encoding": b"binary/compressed",
+                    "compression": algorithm.encode(),
+                },
+                data=result,
+            )
+        return ret
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        ret = list(payloads)
+        indexes: List[int] = []
+        jobs: List[Job] = []
+        for index, p in enumerate(ret):
+            # Ignore ones w/out our expected encoding
+            if p.metadata.get("encoding", b"").decode() != "binary/compressed":
+                continue
+            algorithm = p.metadata.get("compression", b"").decode()
+            if algorithm not in self.algorithms:
+                raise ValueError(f"Unsupported compression {algorithm}")
+            indexes.append(index)
+            jobs.append((partial(_decompress, algorithm), p.data))
+        for index, data in zip(indexes, await self._apply(jobs)):
+            ret[index] = Payload.FromString(data)
+        return ret
+
+
+class CodecChain(PayloadCodec):
+    """Applies codecs in order when encoding and in reverse when decoding."""
+
+    def __init__(self, codecs: Sequence[PayloadCodec]) -> None:
+        super().__init__()
+        self.codecs = list(codecs)
+
+    async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        ret = list(payloads)
+        for codec in self.codecs:
+            ret = await codec.encode(ret)
+        return ret
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        ret = list(payloads)
+        for codec in reversed(self.codecs):
+            ret = await codec.decode(ret)
+        return ret
@@ -0,0 +1,77 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from temporalio.api.common.v1 import Payload
+from temporalio.converter import PayloadCodec
+
+
+class CachingCodec(PayloadCodec):
+    """Caches what another codec decodes, keyed by a digest of the input.
+
+    Repeated decodes of the same payloads, e.g. when a history is refreshed in
+    the UI or replayed, become memory lookups. Decoded payloads are kept in an
+    LRU of at most ``max_bytes`` of serialized payloads. Encoding is not
+    cached, since encryption is not deterministic. Decoded payloads are
+    plaintext, so only enable this where keeping them in memory is acceptable.
+    """
+
+    def __init__(self, codec: PayloadCodec, max_bytes: int = 64 * 1024 * 1024):
+        super().__init__()
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # Serialized decoded payloads by digest, least recently used first
+        self._entries: "OrderedDict[bytes, bytes]" = OrderedDict()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.size,
+        }
+
+    async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        return await self.codec.encode(list(payloads))
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        ret: List[Payload] = []
+        # Indexes in ret of the payloads to decode, with their digests
+        misses: List[int] = []
+        digests: List[bytes] = []
+        for p in payloads:
+            digest = hashlib.sha256(p.SerializeToString()).digest()
+            cached = self._entries.get(digest)
+            if cached is not None:
+                self.hits += 1
+                self._entries.move_to_end(digest)
+                ret.append(Payload.FromString(cached))
+                continue
+            self.misses += 1
+            misses.append(len(ret))
+            digests.append(digest)
+            ret.append(p)
+        if misses:
+            decoded = await self.codec.decode([ret[index] for index in misses])
+            for index, digest, p in zip(misses, digests, decoded):
+                ret[index] = p
+                self._put(digest, p.SerializeToString())
+        return ret
+
+    def _put(self, digest: bytes, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        previous = self._entries.pop(digest, None)
+        if previous is not None:
+            self.size -= len(previous)
+        self._entries[digest] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
@@ -0,0 +1,161 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import Executor
+from datetime import timedelta
+from functools import partial
+from typing import Iterable, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from temporalio.api.common.v1 import Payload
+
+from encryption.codec import (
+    Job,
+    OffloadingCodec,
+    decrypt_with,
+    default_key,
+    default_key_id,
+    encrypt_with,
+)
+
+
+class KeyWrapper(ABC):
+    """Wraps and unwraps data keys with a master key, e.g. held in a KMS."""
+
+    # ID of the master key, recorded in payload metadata
+    key_id: str
+
+    @abstractmethod
+    async def wrap(self, data_key: bytes) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def unwrap(self, wrapped_key: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class LocalKeyWrapper(KeyWrapper):
+    """Wraps data keys with a master key held in this process.
+
+    Stands in for a KMS, whose client would make the same two calls remotely.
+    """
+
+    def __init__(self, key_id: str = default_key_id, key: bytes = default_key):
+        self.key_id = key_id
+        self.cipher = AESGCM(key)
+
+    async def wrap(self, data_key: bytes) -> bytes:
+        return encrypt_with(self.cipher, data_key)
+
+    async def unwrap(self, wrapped_key: bytes) -> bytes:
+        return decrypt_with(self.cipher, wrapped_key)
+
+
+class EnvelopeEncryptionCodec(OffloadingCodec):
+    """Encrypts payloads with data keys wrapped by a master key.
+
+    A data key is generated for each ``data_key_ttl`` window and wrapped once,
+    so the master key is used once per window rather than once per payload.
+    Each payload carries its wrapped data key in its metadata. Unwrapped data
+    keys are kept in an LRU of ``cache_size`` keys, so decoding only unwraps
+    keys it hasn't seen recently.
+    """
+
+    def __init__(
+        self,
+        wrapper: KeyWrapper,
+        *,
+        data_key_ttl: timedelta = timedelta(hours=1),
+        cache_size: int = 1000,
+        offload_threshold: Optional[int] = 64 * 1024,
+        offload_batch_bytes: int = 1024 * 1024,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        super().__init__(
+            offload_threshold=offload_threshold,
+            offload_batch_bytes=offload_batch_bytes,
+            executor=executor,
+        )
+        self.wrapper = wrapper
+        self.data_key_ttl = data_key_ttl
+        self.cache_size = cache_size
+        # Unwrapped data keys by wrapped key, least recently used first
+        self._data_keys: "OrderedDict[bytes, AESGCM]" = OrderedDict()
+        # Wrapped key and monotonic expiry of the data key used to encrypt
+        self._current: Optional[Tuple[bytes, float]] = None
+        self._lock = asyncio.Lock()
+
+    async def encode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        wrapped_key, cipher = await self._current_data_key()
+        encrypt = partial(encrypt_with, cipher)
+        encrypted = await self._apply(
+            [(encrypt, p.SerializeToString()) for p in payloads]
+        )
+        return [
+            Payload(
+                metadata={
+                    "encoding": b"binary/encrypted-envelope",
+                    "encryption-key-id": self.wrapper.key_id.encode(),
+                    "encryption-data-key": wrapped_key,
+                },
+                data=data,
+            )
+            for data in encrypted
+        ]
+
+    async def decode(self, payloads: Iterable[Payload]) -> List[Payload]:
+        ret: List[Payload] = []
+        # Indexes in ret of the payloads to decrypt, and how to decrypt them
+        indexes: List[int] = []
+        jobs: List[Job] = []
+        for p in payloads:
+            # Ignore ones w/out our expected encoding
+            encoding = p.metadata.get("encoding", b"").decode()
+            if encoding != "binary/encrypted-envelope":
+                ret.append(p)
+                continue
+            key_id = p.metadata.get("encryption-key-id", b"").decode()
+            if key_id != self.wrapper.key_id:
+                raise ValueError(
+                    f"Unrecognized key ID {key_id}. "
+                    f"Current key ID is {self.wrapper.key_id}."
+                )
+            cipher = await self._data_key(p.metadata["encryption-data-key"])
+            indexes.append(len(ret))
+            jobs.append((partial(decrypt_with, cipher), p.data))
+            ret.append(p)
+        # Decrypt and replace
+        for index, data in zip(indexes, await self._apply(jobs)):
+            ret[index] = Payload.FromString(data)
+        return ret
+
+    async def _current_data_key(self) -> Tuple[bytes, AESGCM]:
+        # Concurrent encodes wait for one new data key rather than each
+        # wrapping their own
+        async with self._lock:
+            if self._current is None or self._current[1] <= time.monotonic():
+                data_key = AESGCM.generate_key(bit_length=256)
+                wrapped_key = await self.wrapper.wrap(data_key)
+                self._cache(wrapped_key, AESGCM(data_key))
+                self._current = (
+                    wrapped_key,
+                    time.monotonic() + self.data_key_ttl.total_seconds(),
+                )
+            wrapped_key = self._current[0]
+        return wrapped_key, await self._data_key(wrapped_key)
+
+    async def _data_key(self, wrapped_key: bytes) -> AESGCM:
+        cipher = self._data_keys.get(wrapped_key)
+        if cipher is not None:
+            self._data_keys.move_to_end(wrapped_key)
+            return cipher
+        cipher = AESGCM(await self.wrapper.unwrap(wrapped_key))
+        self._cache(wrapped_key, cipher)
+        return cipher
+
+    def _cache(self, wrapped_key: bytes, cipher: AESGCM) -> None:
+        self._data_keys[wrapped_key] = cipher
+        self._data_keys.move_to_end(wrapped_key)
+        while len(self._data_keys) > self.cache_size:
+            self._data_keys.popitem(last=False)
@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Looks up a key by ID, e.g. in a secrets manager, returning None if unknown
+KeyProvider = Callable[[str], Optional[bytes]]
+
+
+class KeyRing:
+    """Keys by ID, with the ID of the key new payloads are encrypted with.
+
+    Each key's AESGCM cipher is created once and cached by key ID. Keys that
+    are not given up front are loaded from the provider on first use and
+    cached for the TTL, after which they are loaded again, so keys revoked in
+    the provider stop being usable. Key IDs the provider doesn't know are
+    remembered for the miss TTL, so payloads with an unknown key don't each
+    cost a lookup. Expired keys and misses are evicted as keys are loaded.
+    """
+
+    def __init__(
+        self,
+        keys: Mapping[str, bytes],
+        current_key_id: str,
+        provider: Optional[KeyProvider] = None,
+        ttl: timedelta = timedelta(minutes=10),
+        miss_ttl: timedelta = timedelta(seconds=30),
+    ) -> None:
+        self.provider = provider
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        # Guards the caches only, the provider is called without it
+        self._lock = threading.Lock()
+        # Cipher and monotonic expiry of each key, None for keys given here
+        self._ciphers: Dict[str, Tuple[AESGCM, Optional[float]]] = {
+            key_id: (AESGCM(key), None) for key_id, key in keys.items()
+        }
+        # Monotonic expiry of each key ID the provider didn't know
+        self._misses: Dict[str, float] = {}
+        # Expired entries are dropped when loading, at most once per the
+        # shorter TTL, so they outlive their TTL by at most that much
+        self._next_prune = 0.0
+        self._current_key_id = current_key_id
+        # Fail on a missing current key now rather than on the first encode
+        self.get(current_key_id)
+
+    @property
+    def current_key_id(self) -> str:
+        return self._current_key_id
+
+    def current(self) -> Tuple[str, AESGCM]:
+        """The current key ID and its cipher."""
+        key_id = self._current_key_id
+        return key_id, self.get(key_id)
+
+    def get(self, key_id: str) -> AESGCM:
+        """The cipher of a key, loading it from the provider if needed.
+
+        This blocks while the provider is called, use :py:meth:`resolve` on
+        an event loop.
+        """
+        return self._cached(key_id) or self._load(key_id)
+
+    async def resolve(self, key_ids: Iterable[str]) -> Dict[str, AESGCM]:
+        """The ciphers of the given keys by ID.
+
+        Keys that aren't cached are loaded from the provider in the loop's
+        default executor, so a slow provider doesn't stall the event loop.
+        """
+        ciphers: Dict[str, AESGCM] = {}
+        missing: List[str] = []
+        for key_id in set(key_ids):
+            cipher = self._cached(key_id)
+            if cipher is None:
+                missing.append(key_id)
+            else:
+                ciphers[key_id] = cipher
+        if missing:
+            loop = asyncio.get_running_loop()
+            loaded = await asyncio.gather(
+                *[loop.run_in_executor(None, self._load, key_id) for key_id in missing]
+            )
+            ciphers.update(zip(missing, loaded))
+        return ciphers
+
+    def _cached(self, key_id: str) -> Optional[AESGCM]:
+        # Raises for key IDs the provider recently didn't know
+        now = time.monotonic()
+        with self._lock:
+            cached = self._ciphers.get(key_id)
+            if cached and (cached[1] is None or cached[1] > now):
+                return cached[0]
+            if self._misses.get(key_id, 0) > now:
+                raise ValueError(f"Unrecognized key ID {key_id}")
+            return None
+
+    def _load(self, key_id: str) -> AESGCM:
+        key = self.provider(key_id) if self.provider else None
+        with self._lock:
+            self._prune()
+            if key is None:
+                self._ciphers.pop(key_id, None)
+                self._misses[key_id] = time.monotonic() + self.miss_ttl.total_seconds()
+                raise ValueError(f"Unrecognized key ID {key_id}")
+            self._misses.pop(key_id, None)
+            cipher = AESGCM(key)
+            self._ciphers[key_id] = (
+                cipher,
+                time.monotonic() + self.ttl.total_seconds(),
+            )
+            return cipher
+
+    def _prune(self) -> None:
+        # Must hold the lock
+        now = time.monotonic()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + min(self.ttl, self.miss_ttl).total_seconds()
+        for key_id, (_, expiry) in list(self._ciphers.items()):
+            if expiry is not None and expiry <= now:
+                del self._ciphers[key_id]
+        for key_id, expiry in list(self._misses.items()):
+            if expiry <= now:
+                del self._misses[key_id]
+
+    def rotate(self, key_id: str, key: Optional[bytes] = None) -> None:
+        """Encrypt with the given key from now on.
+
+        Payloads encrypted with previous keys can still be decrypted as long
+        as those keys stay in the ring or the provider.
+        """
+        if key is not None:
+            with self._lock:
+                self._ciphers[key_id] = (AESGCM(key), None)
+                self._misses.pop(key_id, None)
+        self.get(key_id)
+        self._current_key_id = key_id
@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List
+
+import aiohttp
+from google.protobuf import json_format
+from temporalio.api.common.v1 import Payload, Payloads
+
+from encryption.codec import EncryptionCodec
+from encryption.codec_server import JSON, PROTOBUF
+from encryption.compression import CodecChain, CompressionCodec
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_load(
+    url: str,
+    size: int,
+    payloads_per_request: int,
+    requests: int,
+    concurrency: int,
+    content_type: str,
+) -> Dict[str, float]:
+    """Function that posts the same encoded payloads to /decode repeatedly."""
+    # Random data, so compression doesn't shrink what is sent
+    codec = CodecChain([CompressionCodec(), EncryptionCodec()])
+    payloads = Payloads(
+        payloads=await codec.encode(
+            [
+                Payload(metadata={"encoding": b"binary/plain"}, data=os.urandom(size))
+                for _ in range(payloads_per_request)
+            ]
+        )
+    )
+    if content_type == JSON:
+        body = json_format.MessageToJson(payloads).encode()
+    else:
+        body = payloads.SerializeToString()
+    headers = {"Content-Type": content_type, "Accept-Encoding": "gzip"}
+
+    latencies: List[float] = []
+    remaining = requests
+
+    async def worker(session: aiohttp.ClientSession) -> None:
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            async with session.post(f"{url}/decode", data=body, headers=headers) as r:
+                r.raise_for_status()
+                await r.read()
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    return {
+        "payload_bytes": size,
+        "requests": requests,
+        "requests_per_sec": requests / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test the codec server")
+    parser.add_argument("--url", default="http://127.0.0.1:8081")
+    parser.add_argument(
+        "--sizes",
+        default="1024,65536,1048576",
+        help="Comma-separated payload sizes in bytes, one run per size",
+    )
+    parser.add_argument("--payloads-per-request", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--protobuf", action="store_true", help="Send protobuf")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        result = await run_load(
+            args.url,
+            size,
+            args.payloads_per_request,
+            args.requests,
+            args.concurrency,
+            PROTOBUF if args.protobuf else JSON,
+        )
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{size:>10} bytes: {result['requests_per_sec']:8.0f} req/s, "
+                f"p50 {result['p50_ms']:7.2f}ms, p99 {result['p99_ms']:7.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,6 +5,7 @@ import temporalio.converter
 from temporalio.client import Client
 
 from encryption.codec import EncryptionCodec
+from encryption.compression import CodecChain, CompressionCodec
 from encryption.worker import GreetingWorkflow
 
 
@@ -12,9 +13,12 @@ async def main():
     # Connect client
     client = await Client.connect(
         "localhost:7233",
-        # Use the default converter, but change the codec
+        # Use the default converter, but change the codec. Payloads are
+        # compressed before they are encrypted, since ciphertext doesn't
+        # compress.
         data_converter=dataclasses.replace(
-            temporalio.converter.default(), payload_codec=EncryptionCodec()
+            temporalio.converter.default(),
+            payload_codec=CodecChain([CompressionCodec(), EncryptionCodec()]),
         ),
     )
 
@@ -0,0 +1,44 @@
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet.compaction import MANIFEST_NAME, compact_partition
+from cloud_export_to_parquet.flatten import flatten_workflow_executions
+from cloud_export_to_parquet.local_s3 import LocalS3
+from tests.cloud_export_to_parquet.flatten_test import make_workflow_executions
+
+
+def test_compact_partition(tmp_path):
+    table = flatten_workflow_executions(make_workflow_executions())[
+        "WORKFLOW_EXECUTION_STARTED"
+    ]
+    s3 = LocalS3(str(tmp_path))
+    partition = "parquet/hour=00/event_type=WORKFLOW_EXECUTION_STARTED"
+    sources = []
+    for i in range(5):
+        sink = io.BytesIO()
+        pq.write_table(table, sink)
+        sources.append(f"{partition}/{i}.parquet")
+        s3.put_object(Bucket="bucket", Key=sources[-1], Body=sink.getvalue())
+
+    env = ActivityEnvironment()
+    manifest_key = env.run(compact_partition, s3, "bucket", partition, 1 << 20, 100)
+
+    objects = s3.objects("bucket")
+    manifest = json.loads(objects[manifest_key])
+    assert manifest_key == f"{partition}/{MANIFEST_NAME}"
+    assert len(manifest["files"]) == 1
+    compacted = manifest["files"][0]
+    assert compacted["sources"] == sources
+    assert compacted["rows"] == 5 * table.num_rows
+    assert sorted(objects) == sorted([compacted["key"], manifest_key])
+    merged = pq.ParquetFile(io.BytesIO(objects[compacted["key"]]))
+    assert merged.num_row_groups == 1
+    assert merged.read() == pa.concat_tables([table] * 5)
+
+    # Rerunning finds nothing left to merge
+    env.run(compact_partition, s3, "bucket", partition, 1 << 20, 100)
+    assert s3.objects("bucket") == objects
@@ -0,0 +1,181 @@
+import copy
+import dataclasses
+import io
+import json
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Dict, List
+
+import pyarrow.parquet as pq
+import pytest
+from temporalio.testing import ActivityEnvironment
+
+from cloud_export_to_parquet import data_trans_activities, parquet_sink
+from cloud_export_to_parquet.data_trans_activities import (
+    DataTransActivities,
+    DataTransAndLandActivityInput,
+    GetObjectKeysActivityInput,
+    iter_object_key_pages,
+)
+from cloud_export_to_parquet.local_s3 import LocalS3
+from tests.cloud_export_to_parquet.flatten_test import make_workflow_executions
+
+
+class FailingS3(LocalS3):
+    def __init__(self, root: str, fail_on_put: int = 0, fail_on_part: int = 0) -> None:
+        super().__init__(root)
+        self.fail_on_put = fail_on_put
+        self.fail_on_part = fail_on_part
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes) -> None:
+        self.fail_on_put -= 1
+        if self.fail_on_put == 0:
+            raise RuntimeError("Transient failure")
+        super().put_object(Bucket, Key, Body)
+
+    def upload_part(
+        self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body: bytes
+    ) -> Dict[str, Any]:
+        self.fail_on_part -= 1
+        if self.fail_on_part == 0:
+            raise RuntimeError("Transient failure")
+        return super().upload_part(Bucket, Key, UploadId, PartNumber, Body)
+
+
+def test_data_trans_and_land_resumes_from_heartbeat(monkeypatch, tmp_path):
+    wfs = make_workflow_executions()
+    for _ in range(2):
+        wfs.items.add().CopyFrom(wfs.items[0])
+    LocalS3(str(tmp_path)).put_object(
+        Bucket="export-bucket", Key="export/file", Body=wfs.SerializeToString()
+    )
+    s3 = FailingS3(str(tmp_path), fail_on_put=5)
+    monkeypatch.setattr(data_trans_activities, "_s3_client", lambda _: s3)
+    activity_input = DataTransAndLandActivityInput(
+        "export-bucket", "export/file", "output-bucket", "parquet", max_rows_per_file=2
+    )
+
+    # First attempt lands two of the three histories, one set of files each,
+    # and fails
+    heartbeats: List[Any] = []
+    env = ActivityEnvironment()
+    env.on_heartbeat = lambda *details: heartbeats.append(copy.deepcopy(details[0]))
+    with pytest.raises(RuntimeError):
+        env.run(DataTransActivities().data_trans_and_land, activity_input)
+    checkpoint = heartbeats[-1]
+    assert checkpoint.histories_processed == 2
+    assert len(checkpoint.keys) == 4
+
+    # The retry only converts the last history
+    env = ActivityEnvironment()
+    env.info = dataclasses.replace(
+        env.info, heartbeat_details=[dataclasses.asdict(checkpoint)]
+    )
+    result = env.run(DataTransActivities().data_trans_and_land, activity_input)
+    assert result.landed_files == 6
+    objects = s3.objects("output-bucket")
+    landed = [key for key in objects if "/_landed/" in key]
+    assert len(landed) == 1
+    keys = json.loads(objects[landed[0]])["keys"]
+    assert keys[:4] == checkpoint.keys
+    assert len(keys) == 6
+    assert set(keys) == set(objects) - set(landed)
+
+    # Once landed, a rerun only checks the marker
+    calls = len(s3.calls)
+    env = ActivityEnvironment()
+    result = env.run(DataTransActivities().data_trans_and_land, activity_input)
+    assert result.already_landed
+    assert s3.objects("output-bucket") == objects
+    assert s3.calls[calls:] == ["head_object", "head_object"]
+
+    # Files written in multipart uploads are aborted when an attempt fails
+    monkeypatch.setattr(parquet_sink, "MIN_PART_SIZE", 1024)
+    monkeypatch.setattr(
+        data_trans_activities,
+        "S3MultipartUpload",
+        partial(parquet_sink.S3MultipartUpload, part_size=1024),
+    )
+    s3 = FailingS3(str(tmp_path), fail_on_part=2)
+    activity_input = dataclasses.replace(activity_input, write_path="multipart")
+    heartbeats.clear()
+    env = ActivityEnvironment()
+    env.on_heartbeat = lambda *details: heartbeats.append(copy.deepcopy(details[0]))
+    with pytest.raises(RuntimeError):
+        env.run(DataTransActivities().data_trans_and_land, activity_input)
+    assert heartbeats[-1].uploads == []
+    assert s3.calls.count("abort_multipart_upload") == 1
+
+    # A retry from an earlier heartbeat, still listing the aborted upload,
+    # doesn't fail on aborting it again
+    checkpoint = next(h for h in reversed(heartbeats) if h.uploads)
+    env = ActivityEnvironment()
+    env.info = dataclasses.replace(
+        env.info, heartbeat_details=[dataclasses.asdict(checkpoint)]
+    )
+    result = env.run(DataTransActivities().data_trans_and_land, activity_input)
+    assert result.landed_files == 6
+    assert s3.calls.count("abort_multipart_upload") == 2
+
+
+def test_data_trans_and_land_in_process_pool(monkeypatch, tmp_path):
+    monkeypatch.setattr(data_trans_activities, "CONVERSION_BATCH_BYTES", 1024)
+    wfs = make_workflow_executions()
+    for _ in range(100):
+        wfs.items.add().CopyFrom(wfs.items[0])
+    s3 = LocalS3(str(tmp_path))
+    s3.put_object(
+        Bucket="export-bucket", Key="export/file", Body=wfs.SerializeToString()
+    )
+    monkeypatch.setattr(data_trans_activities, "_s3_client", lambda _: s3)
+
+    def land(write_path: str, activities: DataTransActivities) -> Dict[str, Any]:
+        ActivityEnvironment().run(
+            activities.data_trans_and_land,
+            DataTransAndLandActivityInput(
+                "export-bucket", "export/file", "output-bucket", write_path
+            ),
+        )
+        return {
+            key[len(write_path) :]: pq.read_table(io.BytesIO(data)).to_pylist()
+            for key, data in s3.objects("output-bucket").items()
+            if key.startswith(write_path) and key.endswith(".parquet")
+        }
+
+    with ProcessPoolExecutor(2) as executor:
+        pooled = land("pooled", DataTransActivities(conversion_executor=executor))
+    assert pooled == land("threaded", DataTransActivities())
+    assert len(pooled) == 2
+
+
+def test_get_object_keys_pages(monkeypatch, tmp_path):
+    s3 = LocalS3(str(tmp_path))
+    keys = [f"export/{i:02}" for i in range(7)]
+    for key in keys:
+        s3.put_object(Bucket="export-bucket", Key=key, Body=b"")
+    s3.put_object(Bucket="export-bucket", Key="other/file", Body=b"")
+
+    # Pages are listed lazily, each continuing from the previous one
+    pages = list(iter_object_key_pages(s3, "export-bucket", "export/", page_size=3))
+    assert [page.keys for page in pages] == [keys[:3], keys[3:6], keys[6:]]
+    assert [page.next_start_after for page in pages] == [keys[2], keys[5], None]
+    assert s3.calls.count("list_objects_v2") == 3
+
+    # The activity returns one page, with the cursor to start the next after
+    monkeypatch.setattr(data_trans_activities, "_s3_client", lambda _: s3)
+    env = ActivityEnvironment()
+    start_after = None
+    listed: List[str] = []
+    while True:
+        page = env.run(
+            DataTransActivities().get_object_keys,
+            GetObjectKeysActivityInput(
+                "export-bucket", "export/", start_after=start_after, page_size=3
+            ),
+        )
+        listed.extend(page.keys)
+        assert len(page.etags) == len(page.keys)
+        if page.next_start_after is None:
+            break
+        start_after = page.next_start_after
+    assert listed == keys
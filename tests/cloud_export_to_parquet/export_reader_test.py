@@ -0,0 +1,30 @@
+import temporalio.api.export.v1 as export
+
+from cloud_export_to_parquet.export_reader import (
+    download_object,
+    iter_workflow_executions,
+)
+from cloud_export_to_parquet.local_s3 import LocalS3
+from tests.cloud_export_to_parquet.flatten_test import make_workflow_executions
+
+
+def test_iter_workflow_executions(tmp_path):
+    wfs = make_workflow_executions()
+    for i in range(3):
+        wf = wfs.items.add()
+        wf.CopyFrom(wfs.items[0])
+        wf.history.events[0].event_id = i + 10
+    s3 = LocalS3(str(tmp_path))
+    s3.put_object(Bucket="bucket", Key="export/file", Body=wfs.SerializeToString())
+
+    with download_object(s3, "bucket", "export/file") as f:
+        assert list(iter_workflow_executions(f)) == list(wfs.items)
+        assert list(iter_workflow_executions(f, skip=2)) == list(wfs.items[2:])
+
+    s3.put_object(
+        Bucket="bucket",
+        Key="export/empty",
+        Body=export.WorkflowExecutions().SerializeToString(),
+    )
+    with download_object(s3, "bucket", "export/empty") as f:
+        assert list(iter_workflow_executions(f)) == []
@@ -0,0 +1,116 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import temporalio.api.export.v1 as export
+from temporalio.api.common.v1 import Payload
+from temporalio.api.enums.v1 import EventType
+from temporalio.api.history.v1 import History
+
+from cloud_export_to_parquet.flatten import flatten_workflow_executions
+from cloud_export_to_parquet.schema import event_plan
+
+
+def make_workflow_executions() -> export.WorkflowExecutions:
+    history = History()
+    started = history.events.add(
+        event_id=1, event_type=EventType.EVENT_TYPE_WORKFLOW_EXECUTION_STARTED
+    )
+    started.event_time.FromSeconds(1700000000)
+    attrs = started.workflow_execution_started_event_attributes
+    attrs.workflow_id = "my-workflow-id"
+    attrs.original_execution_run_id = "my-run-id"
+    attrs.workflow_type.name = "MyWorkflow"
+    attrs.workflow_run_timeout.FromSeconds(60)
+    attrs.input.payloads.add(data=b'"secret"')
+    attrs.memo.fields["my.key"].CopyFrom(Payload(data=b"1"))
+    completed = history.events.add(
+        event_id=2, event_type=EventType.EVENT_TYPE_WORKFLOW_EXECUTION_COMPLETED
+    )
+    completed_attrs = completed.workflow_execution_completed_event_attributes
+    completed_attrs.result.payloads.add(data=b'"result"')
+    completed_attrs.workflow_task_completed_event_id = 1
+    wfs = export.WorkflowExecutions()
+    wfs.items.add(history=history)
+    return wfs
+
+
+def test_flatten_workflow_executions():
+    tables = flatten_workflow_executions(make_workflow_executions())
+    assert set(tables) == {
+        "WORKFLOW_EXECUTION_STARTED",
+        "WORKFLOW_EXECUTION_COMPLETED",
+    }
+    started = tables["WORKFLOW_EXECUTION_STARTED"]
+    # Columns are fixed by the event type's schema, not by the data
+    assert started.schema == event_plan("WORKFLOW_EXECUTION_STARTED").schema
+    assert not any("payloads" in name.lower() for name in started.column_names)
+    assert not any("memo" in name for name in started.column_names)
+    row = started.to_pylist()[0]
+    assert row["WorkflowId"] == "my-workflow-id"
+    assert row["RunId"] == "my-run-id"
+    assert row["eventId"] == 1
+    assert row["eventTime"] == datetime(2023, 11, 14, 22, 13, 20, tzinfo=timezone.utc)
+    assert row["eventType"] == "EVENT_TYPE_WORKFLOW_EXECUTION_STARTED"
+    assert row["workflowExecutionStartedEventAttributes_workflowType_name"] == (
+        "MyWorkflow"
+    )
+    assert row["workflowExecutionStartedEventAttributes_workflowRunTimeout"] == (
+        timedelta(seconds=60)
+    )
+    assert row["workflowExecutionStartedEventAttributes_attempt"] is None
+
+    completed = tables["WORKFLOW_EXECUTION_COMPLETED"].to_pylist()
+    assert completed[0]["WorkflowId"] == "my-workflow-id"
+    assert (
+        completed[0][
+            "workflowExecutionCompletedEventAttributes_workflowTaskCompletedEventId"
+        ]
+        == 1
+    )
+
+
+def test_flatten_workflow_executions_projection():
+    tables = flatten_workflow_executions(
+        make_workflow_executions(),
+        event_types=frozenset(["WORKFLOW_EXECUTION_STARTED"]),
+        columns=frozenset(
+            ["eventId", "workflowExecutionStartedEventAttributes_workflowType_name"]
+        ),
+    )
+    assert list(tables) == ["WORKFLOW_EXECUTION_STARTED"]
+    assert tables["WORKFLOW_EXECUTION_STARTED"].to_pylist() == [
+        {
+            "WorkflowId": "my-workflow-id",
+            "RunId": "my-run-id",
+            "eventId": 1,
+            "workflowExecutionStartedEventAttributes_workflowType_name": "MyWorkflow",
+        }
+    ]
+
+
+def test_flatten_workflow_executions_drops_nested_payloads():
+    history = History()
+    failed = history.events.add(
+        event_id=1, event_type=EventType.EVENT_TYPE_ACTIVITY_TASK_FAILED
+    )
+    failure = failed.activity_task_failed_event_attributes.failure
+    failure.message = "outer"
+    failure.encoded_attributes.data = b'"secret"'
+    failure.application_failure_info.details.payloads.add(data=b'"secret"')
+    failure.cause.message = "inner"
+    failure.cause.encoded_attributes.data = b'"secret"'
+    failure.cause.application_failure_info.type = "MyError"
+    failure.cause.application_failure_info.details.payloads.add(data=b'"secret"')
+    wfs = export.WorkflowExecutions()
+    wfs.items.add(history=history)
+
+    row = flatten_workflow_executions(wfs)["ACTIVITY_TASK_FAILED"].to_pylist()[0]
+    assert row["activityTaskFailedEventAttributes_failure_message"] == "outer"
+    # Recursive messages are kept as JSON, without their payloads
+    assert json.loads(row["activityTaskFailedEventAttributes_failure_cause"]) == {
+        "message": "inner",
+        "applicationFailureInfo": {"type": "MyError"},
+    }
+    assert not any(
+        "secret" in str(value) or "InNlY3JldCI" in str(value) for value in row.values()
+    )
@@ -0,0 +1,43 @@
+import io
+
+import pyarrow.parquet as pq
+
+from cloud_export_to_parquet import parquet_sink
+from cloud_export_to_parquet.flatten import flatten_workflow_executions
+from cloud_export_to_parquet.local_s3 import LocalS3
+from cloud_export_to_parquet.schema import SCHEMA_VERSION_METADATA_KEY, schema_version
+from tests.cloud_export_to_parquet.flatten_test import make_workflow_executions
+
+
+def test_partitioned_parquet_writer_multipart(monkeypatch, tmp_path):
+    monkeypatch.setattr(parquet_sink, "MIN_PART_SIZE", 1024)
+    wfs = make_workflow_executions()
+    for _ in range(200):
+        wfs.items.add().CopyFrom(wfs.items[0])
+
+    s3 = LocalS3(str(tmp_path))
+    writer = parquet_sink.PartitionedParquetWriter(
+        lambda event_type: parquet_sink.S3MultipartUpload(
+            s3, "bucket", f"event_type={event_type}/file.parquet", part_size=1024
+        ),
+        row_group_size=50,
+    )
+    for wf in wfs.items:
+        writer.write_history(wf)
+    keys = writer.close()
+
+    assert keys == [
+        "event_type=WORKFLOW_EXECUTION_STARTED/file.parquet",
+        "event_type=WORKFLOW_EXECUTION_COMPLETED/file.parquet",
+    ]
+    assert s3.calls.count("complete_multipart_upload") == 2
+    expected = flatten_workflow_executions(wfs)
+    objects = s3.objects("bucket")
+    for key in keys:
+        parquet_file = pq.ParquetFile(io.BytesIO(objects[key]))
+        assert parquet_file.num_row_groups == 5
+        assert parquet_file.schema_arrow.metadata[
+            SCHEMA_VERSION_METADATA_KEY
+        ] == schema_version().encode("utf-8")
+        event_type = key.split("/")[0][len("event_type=") :]
+        assert parquet_file.read().to_pylist() == expected[event_type].to_pylist()
@@ -0,0 +1,170 @@
+import asyncio
+import dataclasses
+import uuid
+from typing import List, Optional
+
+import pytest
+from temporalio import activity
+from temporalio.client import Client, WorkflowFailureError
+from temporalio.exceptions import ApplicationError
+from temporalio.worker import Worker
+
+from cloud_export_to_parquet.data_trans_activities import (
+    CompactPartitionActivityInput,
+    DataTransAndLandActivityInput,
+    DataTransAndLandResult,
+    GetObjectKeysActivityInput,
+    GetPartitionsActivityInput,
+    ObjectKeysPage,
+    RegisterSchemaActivityInput,
+)
+from cloud_export_to_parquet.workflows import (
+    CompactParquet,
+    ProtoToParquet,
+    ProtoToParquetSummary,
+    ProtoToParquetWorkflowInput,
+)
+
+
+class MockedActivities:
+    def __init__(self, keys: List[str], failing_key: Optional[str] = None) -> None:
+        self.keys = keys
+        self.failing_key = failing_key
+        self.listed_after: List[Optional[str]] = []
+        self.schemas_registered = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.compacted: List[str] = []
+
+    @activity.defn(name="get_object_keys")
+    async def get_object_keys(
+        self, activity_input: GetObjectKeysActivityInput
+    ) -> ObjectKeysPage:
+        self.listed_after.append(activity_input.start_after)
+        start_after = activity_input.start_after or ""
+        keys = [key for key in self.keys if key > start_after]
+        page = keys[: activity_input.page_size]
+        next_start_after = page[-1] if len(keys) > len(page) else None
+        return ObjectKeysPage(page, next_start_after, [f"etag-{k}" for k in page])
+
+    @activity.defn(name="register_schema")
+    async def register_schema(self, activity_input: RegisterSchemaActivityInput) -> str:
+        self.schemas_registered += 1
+        return f"{activity_input.path}/_schemas/1.json"
+
+    @activity.defn(name="data_trans_and_land")
+    async def data_trans_and_land(
+        self, activity_input: DataTransAndLandActivityInput
+    ) -> DataTransAndLandResult:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.05)
+        finally:
+            self.in_flight -= 1
+        if activity_input.object_key == self.failing_key:
+            raise ApplicationError("Corrupt export file", non_retryable=True)
+        if activity_input.object_key == self.keys[0]:
+            return DataTransAndLandResult(0, already_landed=True)
+        return DataTransAndLandResult(2)
+
+    @activity.defn(name="get_partitions")
+    async def get_partitions(
+        self, activity_input: GetPartitionsActivityInput
+    ) -> List[str]:
+        return [f"{activity_input.path}/event_type={t}" for t in ("A", "B")]
+
+    @activity.defn(name="compact_partition")
+    async def compact_partition(
+        self, activity_input: CompactPartitionActivityInput
+    ) -> str:
+        self.compacted.append(activity_input.partition)
+        return f"{activity_input.partition}/_manifest.json"
+
+
+async def run_proto_to_parquet(
+    client: Client,
+    activities: MockedActivities,
+    workflow_input: ProtoToParquetWorkflowInput,
+):
+    task_queue = str(uuid.uuid4())
+    async with Worker(
+        client,
+        task_queue=task_queue,
+        workflows=[ProtoToParquet, CompactParquet],
+        activities=[
+            activities.get_object_keys,
+            activities.register_schema,
+            activities.data_trans_and_land,
+            activities.get_partitions,
+            activities.compact_partition,
+        ],
+    ):
+        return await client.execute_workflow(
+            ProtoToParquet.run,
+            workflow_input,
+            id=str(uuid.uuid4()),
+            task_queue=task_queue,
+        )
+
+
+async def test_proto_to_parquet_reports_failed_keys(client: Client):
+    activities = MockedActivities(["k1", "k2", "k3", "k4"], failing_key="k3")
+    with pytest.raises(WorkflowFailureError) as err:
+        await run_proto_to_parquet(
+            client,
+            activities,
+            ProtoToParquetWorkflowInput(
+                2,
+                "export-bucket",
+                "my-namespace",
+                "output-bucket",
+                max_parallel_files=1,
+                page_size=2,
+                compact_after_landing=True,
+            ),
+        )
+
+    # Each page is listed by its own run, carrying the summary over, and the
+    # failed file is reported once every file of the hour was attempted
+    assert activities.listed_after == [None, "k2"]
+    assert activities.schemas_registered == 1
+    assert activities.max_in_flight == 1
+    assert not activities.compacted
+    cause = err.value.cause
+    assert isinstance(cause, ApplicationError)
+    assert "failed for 1 files" in cause.message
+    result = cause.details[0]
+    assert result["write_path"].startswith(
+        "temporal-workflow-history/parquet/namespace=my-namespace/"
+    )
+    assert result["summary"] == dataclasses.asdict(
+        ProtoToParquetSummary(
+            converted_files=2, skipped_files=1, landed_files=4, failed_keys=["k3"]
+        )
+    )
+
+
+async def test_proto_to_parquet_compacts_after_landing(client: Client):
+    activities = MockedActivities(["k1", "k2", "k3"])
+    result = await run_proto_to_parquet(
+        client,
+        activities,
+        ProtoToParquetWorkflowInput(
+            2,
+            "export-bucket",
+            "my-namespace",
+            "output-bucket",
+            page_size=2,
+            compact_after_landing=True,
+        ),
+    )
+
+    assert activities.listed_after == [None, "k2"]
+    assert result.summary == ProtoToParquetSummary(
+        converted_files=2, skipped_files=1, landed_files=4
+    )
+    assert sorted(activities.compacted) == [
+        f"{result.write_path}/event_type=A",
+        f"{result.write_path}/event_type=B",
+    ]
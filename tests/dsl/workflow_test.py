@@ -0,0 +1,237 @@
+import asyncio
+import contextlib
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Sequence
+
+import dacite
+import pytest
+import yaml
+from temporalio import activity
+from temporalio.client import Client, WorkflowFailureError
+from temporalio.exceptions import ApplicationError
+from temporalio.worker import Worker
+
+from dsl.activities import DSLActivities
+from dsl.workflow import (
+    ActivityInvocation,
+    ActivityStatement,
+    DSLInput,
+    DSLWorkflow,
+    FailurePolicy,
+    ForEach,
+    ForEachStatement,
+    Parallel,
+    ParallelStatement,
+    SequenceStatement,
+)
+
+dsl_dir = Path(__file__).parent.parent.parent / "dsl"
+
+
+def dsl_worker(
+    client: Client, task_queue: str, extra_activities: Sequence[Callable] = ()
+) -> Worker:
+    activities = DSLActivities()
+    return Worker(
+        client,
+        task_queue=task_queue,
+        workflows=[DSLWorkflow],
+        activities=[
+            activities.activity1,
+            activities.activity2,
+            activities.activity3,
+            activities.activity4,
+            activities.activity5,
+            *extra_activities,
+        ],
+    )
+
+
+async def run_dsl(client: Client, dsl_input: DSLInput) -> dict:
+    task_queue = f"tq-{uuid.uuid4()}"
+    async with dsl_worker(client, task_queue):
+        return await client.execute_workflow(
+            DSLWorkflow.run,
+            dsl_input,
+            id=f"wf-{uuid.uuid4()}",
+            task_queue=task_queue,
+        )
+
+
+def load_dsl(file_name: str) -> DSLInput:
+    return dacite.from_dict(DSLInput, yaml.safe_load((dsl_dir / file_name).read_text()))
+
+
+async def test_dag_matches_nested_blocks(client: Client):
+    nested = await run_dsl(client, load_dsl("workflow2.yaml"))
+    dag = await run_dsl(client, load_dsl("workflow3.yaml"))
+    assert dag == nested
+    assert dag["result6"].startswith("[result from activity3: [result from activity3")
+
+
+async def test_foreach_collects_results_in_order(client: Client):
+    result = await run_dsl(client, load_dsl("workflow4.yaml"))
+    assert result["results"] == [
+        f"[result from activity1: {item}]" for item in result["items"]
+    ]
+
+
+async def test_continue_as_new_and_child_workflow(client: Client):
+    expected = await run_dsl(client, load_dsl("workflow2.yaml"))
+    result = await run_dsl(client, load_dsl("workflow5.yaml"))
+    assert result["result6"] == expected["result6"]
+    # Only the outputs are copied back from the child workflow
+    assert "result2" not in result and "result4" not in result
+
+
+async def test_continue_as_new_makes_progress_with_short_history_limit(client: Client):
+    # Shorter than a continued run's history before its first activity, so
+    # every run continues as new after one element
+    dsl_input = load_dsl("workflow1.yaml")
+    dsl_input.max_history_length = 1
+    assert await run_dsl(client, dsl_input) == await run_dsl(
+        client, load_dsl("workflow1.yaml")
+    )
+
+
+async def test_local_activities(client: Client):
+    dsl_input = load_dsl("workflow1.yaml")
+    assert isinstance(dsl_input.root, SequenceStatement)
+    for elem in dsl_input.root.sequence.elements:
+        assert isinstance(elem, ActivityStatement)
+        elem.activity.local = True
+        elem.activity.start_to_close_timeout = 5
+    assert await run_dsl(client, dsl_input) == await run_dsl(
+        client, load_dsl("workflow1.yaml")
+    )
+
+
+class PolicyActivities:
+    def __init__(self) -> None:
+        self.started = asyncio.Event()
+        self.cancelled = asyncio.Event()
+        self.completed = asyncio.Event()
+
+    @activity.defn
+    async def fail(self) -> None:
+        # Fail once the slow activity is running, so there is one to cancel
+        await self.started.wait()
+        raise ApplicationError("Intentional failure", non_retryable=True)
+
+    @activity.defn
+    async def slow(self, seconds: float) -> str:
+        self.started.set()
+        try:
+            for _ in range(int(seconds * 10)):
+                activity.heartbeat()
+                await asyncio.sleep(0.1)
+        except asyncio.CancelledError:
+            self.cancelled.set()
+            raise
+        self.completed.set()
+        return "slow"
+
+    @activity.defn
+    async def double(self, item: int) -> int:
+        if item < 0:
+            raise ApplicationError(f"Negative item {item}", non_retryable=True)
+        return item * 2
+
+    def parallel(self, failure_policy: FailurePolicy) -> DSLInput:
+        # A failing branch alongside one still running when it fails
+        return DSLInput(
+            root=ParallelStatement(
+                Parallel(
+                    branches=[
+                        ActivityStatement(ActivityInvocation("fail")),
+                        ActivityStatement(
+                            ActivityInvocation(
+                                "slow",
+                                arguments=["seconds"],
+                                result="slow",
+                                heartbeat_timeout=1,
+                            )
+                        ),
+                    ],
+                    failure_policy=failure_policy,
+                )
+            ),
+            variables={"seconds": 60 if failure_policy == "fail_fast" else 1},
+        )
+
+
+async def run_with_policy_activities(
+    client: Client, policy_activities: PolicyActivities, dsl_input: DSLInput
+) -> Any:
+    task_queue = f"tq-{uuid.uuid4()}"
+    async with dsl_worker(
+        client,
+        task_queue,
+        [policy_activities.fail, policy_activities.slow, policy_activities.double],
+    ):
+        try:
+            return await client.execute_workflow(
+                DSLWorkflow.run,
+                dsl_input,
+                id=f"wf-{uuid.uuid4()}",
+                task_queue=task_queue,
+            )
+        finally:
+            # Give cancellations time to reach the activities before the
+            # worker shuts down, which would cancel them anyway
+            if (
+                policy_activities.started.is_set()
+                and not policy_activities.completed.is_set()
+            ):
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(policy_activities.cancelled.wait(), 10)
+
+
+async def test_fail_fast_cancels_running_branches(client: Client):
+    policy_activities = PolicyActivities()
+    with pytest.raises(WorkflowFailureError):
+        await run_with_policy_activities(
+            client, policy_activities, policy_activities.parallel("fail_fast")
+        )
+    assert policy_activities.cancelled.is_set()
+    assert not policy_activities.completed.is_set()
+
+
+async def test_wait_all_finishes_branches_before_failing(client: Client):
+    policy_activities = PolicyActivities()
+    with pytest.raises(WorkflowFailureError):
+        await run_with_policy_activities(
+            client, policy_activities, policy_activities.parallel("wait_all")
+        )
+    assert policy_activities.completed.is_set()
+    assert not policy_activities.cancelled.is_set()
+
+
+async def test_best_effort_ignores_failed_branches(client: Client):
+    policy_activities = PolicyActivities()
+    result = await run_with_policy_activities(
+        client, policy_activities, policy_activities.parallel("best_effort")
+    )
+    assert result["slow"] == "slow"
+    assert not policy_activities.cancelled.is_set()
+
+    # Failed foreach items leave None as their results
+    result = await run_with_policy_activities(
+        client,
+        PolicyActivities(),
+        DSLInput(
+            root=ForEachStatement(
+                ForEach(
+                    items="items",
+                    item="item",
+                    activity=ActivityInvocation(
+                        "double", arguments=["item"], result="results"
+                    ),
+                    failure_policy="best_effort",
+                )
+            ),
+            variables={"items": [1, -2, 3]},
+        ),
+    )
+    assert result["results"] == [2, None, 6]
@@ -0,0 +1,318 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from google.protobuf import json_format
+from temporalio.api.common.v1 import Payload, Payloads
+
+from encryption import codec, compression
+from encryption.codec import EncryptionCodec
+from encryption.codec_server import (
+    JSON,
+    PROTOBUF,
+    build_codec_server,
+    parse_payloads_batch,
+    serialize_payloads_batch,
+)
+from encryption.compression import CodecChain, CompressionCodec
+from encryption.decode_cache import CachingCodec
+from encryption.envelope import EnvelopeEncryptionCodec, LocalKeyWrapper
+from encryption.key_ring import KeyRing
+
+
+async def test_encryption_codec_offloads_large_payloads(monkeypatch):
+    threads = set()
+    encrypt = codec.encrypt_with
+
+    def recording_encrypt(*args):
+        threads.add(threading.current_thread())
+        return encrypt(*args)
+
+    monkeypatch.setattr(codec, "encrypt_with", recording_encrypt)
+
+    with ThreadPoolExecutor(2) as executor:
+        encryption_codec = EncryptionCodec(
+            offload_threshold=1024, offload_batch_bytes=4096, executor=executor
+        )
+        payloads = [
+            Payload(metadata={"encoding": b"binary/plain"}, data=bytes([i]) * size)
+            for i, size in enumerate([10, 5000, 20, 5000, 2000, 3000])
+        ]
+        plain = Payload(metadata={"encoding": b"json/plain"}, data=b'"plain"')
+
+        encoded = await encryption_codec.encode(payloads)
+        assert threads - {threading.current_thread()}
+        assert all(p.metadata["encoding"] == b"binary/encrypted" for p in encoded)
+        assert await encryption_codec.decode(encoded + [plain]) == payloads + [plain]
+
+        # Everything stays inline with offloading disabled
+        threads.clear()
+        encryption_codec.offload_threshold = None
+        decoded = await encryption_codec.decode(await encryption_codec.encode(payloads))
+        assert decoded == payloads
+        assert threads == {threading.current_thread()}
+
+
+async def test_encryption_codec_key_rotation():
+    provided = {"old": b"o" * 32}
+    loads = []
+
+    def provider(key_id):
+        loads.append(key_id)
+        return provided.get(key_id)
+
+    key_ring = KeyRing({"current": b"c" * 32}, "current", provider)
+    encryption_codec = EncryptionCodec(key_ring=key_ring)
+    payload = Payload(metadata={"encoding": b"binary/plain"}, data=b"data")
+
+    # Payloads encrypted with an older key are still decrypted
+    old_codec = EncryptionCodec("old", provided["old"])
+    old = await old_codec.encode([payload])
+    assert await encryption_codec.decode(old + old) == [payload, payload]
+    assert loads == ["old"]
+
+    # Rotating changes the key new payloads are encrypted with
+    key_ring.rotate("new", b"n" * 32)
+    new = await encryption_codec.encode([payload])
+    assert new[0].metadata["encryption-key-id"] == b"new"
+    assert await encryption_codec.decode(new + old) == [payload, payload]
+
+    # Provided keys are loaded again after their TTL, so revoked keys fail
+    key_ring = KeyRing({"current": b"c" * 32}, "current", provider, timedelta(0))
+    encryption_codec = EncryptionCodec(key_ring=key_ring)
+    assert await encryption_codec.decode(old) == [payload]
+    del provided["old"]
+    with pytest.raises(ValueError, match="Unrecognized key ID old"):
+        await encryption_codec.decode(old)
+
+
+async def test_key_ring_loads_keys_off_the_event_loop():
+    loads = []
+
+    def provider(key_id):
+        loads.append((key_id, threading.current_thread()))
+        return b"o" * 32 if key_id == "old" else None
+
+    key_ring = KeyRing({"current": b"c" * 32}, "current", provider)
+    encryption_codec = EncryptionCodec(key_ring=key_ring)
+    payload = Payload(metadata={"encoding": b"binary/plain"}, data=b"data")
+    old = await EncryptionCodec("old", b"o" * 32).encode([payload])
+    unknown = await EncryptionCodec("unknown", b"u" * 32).encode([payload])
+
+    # Each key is looked up once per batch, on another thread
+    assert await encryption_codec.decode(old * 3) == [payload] * 3
+    assert [key_id for key_id, _ in loads] == ["old"]
+    assert loads[0][1] is not threading.current_thread()
+
+    # Unknown keys are remembered for the miss TTL
+    for _ in range(3):
+        with pytest.raises(ValueError, match="Unrecognized key ID unknown"):
+            await encryption_codec.decode(unknown * 2)
+    assert [key_id for key_id, _ in loads] == ["old", "unknown"]
+
+
+async def test_compression_before_encryption():
+    chain = CodecChain([CompressionCodec(min_size=100), EncryptionCodec()])
+    large = Payload(metadata={"encoding": b"json/plain"}, data=b'"abc"' * 1000)
+    small = Payload(metadata={"encoding": b"json/plain"}, data=b'"abc"')
+
+    encoded = await chain.encode([large, small])
+    assert len(encoded[0].data) < len(large.data) / 10
+    assert len(encoded[1].data) > len(small.data)
+    assert await chain.decode(encoded) == [large, small]
+
+    # Compressed payloads are marked with their algorithm
+    compressed = await CompressionCodec(min_size=100).encode([large, small])
+    assert compressed[0].metadata["encoding"] == b"binary/compressed"
+    assert compressed[0].metadata["compression"] in (b"zstd", b"zlib")
+    assert compressed[1] == small
+
+
+async def test_compression_codec_offloads_large_payloads(monkeypatch):
+    threads = set()
+    compress = compression._compress
+
+    def recording_compress(*args):
+        threads.add(threading.current_thread())
+        return compress(*args)
+
+    monkeypatch.setattr(compression, "_compress", recording_compress)
+
+    with ThreadPoolExecutor(2) as executor:
+        compression_codec = CompressionCodec(
+            min_size=100, offload_threshold=1024, executor=executor
+        )
+        payloads = [
+            Payload(metadata={"encoding": b"json/plain"}, data=b'"abc"' * size)
+            for size in [10, 1000, 50, 2000]
+        ]
+
+        encoded = await compression_codec.encode(payloads)
+        assert threads - {threading.current_thread()}
+        assert encoded[0] == payloads[0]
+        assert all(p.metadata["encoding"] == b"binary/compressed" for p in encoded[1:])
+        assert await compression_codec.decode(encoded) == payloads
+
+
+async def test_codec_server_protobuf_batch():
+    payloads = Payloads(
+        payloads=[Payload(metadata={"encoding": b"json/plain"}, data=b'"abc"' * 500)]
+    )
+    codec = CodecChain([CompressionCodec(), EncryptionCodec()])
+    encoded = Payloads(payloads=await codec.encode(payloads.payloads))
+    batch = [encoded, Payloads(), encoded]
+
+    async with TestClient(TestServer(build_codec_server())) as client:
+        resp = await client.post(
+            "/decode/batch",
+            data=serialize_payloads_batch(PROTOBUF, batch),
+            headers={
+                "Content-Type": PROTOBUF,
+                "Accept-Encoding": "gzip",
+            },
+        )
+        assert resp.status == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.content_type == PROTOBUF
+        decoded = parse_payloads_batch(PROTOBUF, await resp.read())
+        assert decoded == [payloads, Payloads(), payloads]
+
+        # JSON is still the default
+        resp = await client.post(
+            "/decode",
+            data=json_format.MessageToJson(encoded),
+            headers={"Content-Type": JSON},
+        )
+        assert json_format.Parse(await resp.read(), Payloads()) == payloads
+
+
+async def test_envelope_encryption_caches_data_keys():
+    calls = []
+
+    class CountingKeyWrapper(LocalKeyWrapper):
+        async def wrap(self, data_key: bytes) -> bytes:
+            calls.append("wrap")
+            return await super().wrap(data_key)
+
+        async def unwrap(self, wrapped_key: bytes) -> bytes:
+            calls.append("unwrap")
+            return await super().unwrap(wrapped_key)
+
+    payloads = [
+        Payload(metadata={"encoding": b"json/plain"}, data=f'"{i}"'.encode())
+        for i in range(100)
+    ]
+
+    # One data key is wrapped for every payload encoded in its window
+    codec = EnvelopeEncryptionCodec(CountingKeyWrapper())
+    encoded = [(await codec.encode([p]))[0] for p in payloads]
+    assert calls == ["wrap"]
+    assert len({p.metadata["encryption-data-key"] for p in encoded}) == 1
+    assert await codec.decode(encoded) == payloads
+
+    # Another process unwraps it once and then uses its cache
+    codec = EnvelopeEncryptionCodec(CountingKeyWrapper(), cache_size=1)
+    assert await codec.decode(encoded) == payloads
+    assert calls == ["wrap", "unwrap"]
+
+    # A new data key is generated once the window passes
+    codec.data_key_ttl = timedelta(0)
+    first = await codec.encode(payloads[:1])
+    second = await codec.encode(payloads[:1])
+    assert first[0].metadata["encryption-data-key"] != (
+        second[0].metadata["encryption-data-key"]
+    )
+    assert await codec.decode(encoded[:1] + first) == payloads[:1] * 2
+    assert calls == ["wrap", "unwrap", "wrap", "wrap", "unwrap", "unwrap"]
+
+
+async def test_caching_codec():
+    payloads = [
+        Payload(metadata={"encoding": b"json/plain"}, data=f'"{i}"'.encode())
+        for i in range(3)
+    ]
+    codec = EncryptionCodec()
+    encoded = await codec.encode(payloads)
+    decodes = []
+
+    class CountingCodec(EncryptionCodec):
+        async def decode(self, payloads):
+            payloads = list(payloads)
+            decodes.append(len(payloads))
+            return await super().decode(payloads)
+
+    caching_codec = CachingCodec(CountingCodec(), max_bytes=1000)
+    assert await caching_codec.decode(encoded[:2]) == payloads[:2]
+    assert await caching_codec.decode(encoded) == payloads
+    assert decodes == [2, 1]
+    assert caching_codec.stats()["hits"] == 2
+    assert caching_codec.stats()["misses"] == 3
+
+    # The least recently used payloads are evicted to stay within max_bytes
+    caching_codec = CachingCodec(CountingCodec(), payloads[0].ByteSize() * 2)
+    assert await caching_codec.decode(encoded) == payloads
+    assert await caching_codec.decode(encoded[:1]) == payloads[:1]
+    assert caching_codec.stats() == {
+        "hits": 0,
+        "misses": 4,
+        "evictions": 2,
+        "entries": 2,
+        "bytes": payloads[0].ByteSize() * 2,
+    }
+
+
+async def test_codec_server_gzip_and_malformed_requests():
+    payloads = Payloads(
+        payloads=[Payload(metadata={"encoding": b"json/plain"}, data=b'"abc"' * 500)]
+    )
+    encoded = Payloads(payloads=await EncryptionCodec().encode(payloads.payloads))
+
+    async with TestClient(TestServer(build_codec_server())) as client:
+        # Browsers accept other codings too, but responses are gzipped
+        resp = await client.post(
+            "/decode",
+            data=encoded.SerializeToString(),
+            headers={
+                "Content-Type": PROTOBUF,
+                "Accept-Encoding": "gzip, deflate, br",
+            },
+        )
+        assert resp.status == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert Payloads.FromString(await resp.read()) == payloads
+
+        # Malformed bodies are client errors
+        batch = serialize_payloads_batch(PROTOBUF, [encoded])
+        for path, content_type, body in [
+            ("/decode", JSON, b"{not json"),
+            ("/decode", PROTOBUF, b"\xff\xff"),
+            ("/decode/batch", JSON, b'{"payloads": []}'),
+            ("/decode/batch", PROTOBUF, batch[:-1]),
+        ]:
+            resp = await client.post(
+                path, data=body, headers={"Content-Type": content_type}
+            )
+            assert resp.status == 400, (path, body)
+
+
+def test_key_ring_evicts_expired_keys():
+    def provider(key_id):
+        return b"o" * 32 if key_id.startswith("old") else None
+
+    key_ring = KeyRing(
+        {"current": b"c" * 32},
+        "current",
+        provider,
+        ttl=timedelta(0),
+        miss_ttl=timedelta(0),
+    )
+    for i in range(10):
+        key_ring.get(f"old-{i}")
+        with pytest.raises(ValueError, match="Unrecognized key ID"):
+            key_ring.get(f"unknown-{i}")
+
+    # Only the keys given up front and the latest entries are kept
+    assert set(key_ring._ciphers) <= {"current", "old-9"}
+    assert set(key_ring._misses) <= {"unknown-9"}